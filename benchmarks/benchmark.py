@@ -0,0 +1,376 @@
+"""
+Load test of the ranking service, in-process.
+
+- generate synthetic corpora and user features of a given size, in the layouts written by the preprocessing
+- derive traffic from the frontend logs (or a jsonl file of requests, or synthetic users)
+- replay it against the FastAPI app with concurrent clients, without a network or server in between
+- report throughput and latency percentiles per endpoint and corpus size, and compare them to a baseline
+
+Usage (from this folder):
+    python benchmark.py --documents 10000 100000 --users 1000 --requests 2000 --concurrency 8
+    python benchmark.py --save-baseline baseline.json
+    python benchmark.py --baseline baseline.json
+"""
+
+import argparse
+import asyncio
+import datetime
+import functools
+import glob
+import hashlib
+import json
+import os
+import re
+import sys
+import time
+
+import httpx
+import numpy as np
+import pandas as pd
+
+sys.path.append('..')
+sys.path.append('../ranking_service')
+import utils
+from feature_store import feature_definitions as fd
+from scoring_model.candidate_index import IVFIndex
+from scoring_model.model_utils import LinearScorer, RecommendationModel, load_model, load_scorer
+from scoring_model.quantization import save_embeddings
+import app as service
+from corpus import Corpus, load_embedding_sidecar
+from feature_serving import FeatureServer, ParquetFeatures
+from reloader import ServingState
+
+DATA_DIR = os.path.join(utils.base_folder(), 'data', 'benchmarks')
+LOG_PATTERN = re.compile(r'\{.+?\}')
+WORDS = ('learning neural network language model graph attention transformer reinforcement agent vision '
+         'diffusion retrieval reasoning benchmark robust efficient causal inference optimization').split()
+
+
+class HashingEncoder:
+    """
+    Stand-in for the embedding model: normalized sums of random vectors seeded by the hashes of the words,
+    so texts sharing words get similar embeddings. Orders of magnitude faster than the transformer, to
+    benchmark everything else.
+    """
+
+    def __init__(self, dim=768):
+        self.dim = dim
+
+    @functools.lru_cache(maxsize=100000)
+    def word_vector(self, word):
+        seed = int(hashlib.sha1(word.encode()).hexdigest()[:8], 16)
+        return np.random.default_rng(seed).standard_normal(self.dim).astype(np.float32)
+
+    def encode(self, texts, **kwargs):
+        embeddings = np.zeros((len(texts), self.dim), dtype=np.float32)
+        for i, text in enumerate(texts):
+            for word in text.lower().split():
+                embeddings[i] += self.word_vector(word)
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        return embeddings / np.maximum(norms, 1e-12)
+
+
+def random_text(rng, n_words):
+    return ' '.join(rng.choice(WORDS, n_words))
+
+
+def generate_data(n_documents, n_users, dim=768, seed=0):
+    """
+    Files of a synthetic corpus and users, as written by prepare_features, in a folder per size.
+    Existing files are reused.
+    """
+    folder = os.path.join(DATA_DIR, f'{n_documents}_documents_{n_users}_users_{dim}')
+    paths = {
+        'documents': os.path.join(folder, 'latest_document_features.parquet'),
+        'user': os.path.join(folder, 'latest_user_features.parquet'),
+        'document_embeddings': os.path.join(folder, 'latest_document_embeddings.npy'),
+        'document_index': os.path.join(folder, 'latest_document_index.npz'),
+        'user_query_embeddings': os.path.join(folder, 'latest_user_query_embeddings.npy'),
+        'user_title_embeddings': os.path.join(folder, 'latest_user_title_embeddings.npy'),
+    }
+    if all(os.path.exists(path) for path in paths.values()):
+        return paths
+    print(f'Generating {n_documents} documents and {n_users} users in {folder}')
+    os.makedirs(folder, exist_ok=True)
+    rng = np.random.default_rng(seed)
+    encoder = HashingEncoder(dim)
+    today = datetime.datetime(2024, 10, 25)
+    titles = [random_text(rng, 8) for _ in range(n_documents)]
+    published = [today - datetime.timedelta(days=int(d)) for d in rng.integers(0, 10, n_documents)]
+    embeddings = encoder.encode(titles)
+    documents = pd.DataFrame({
+        'entry_id': [f'http://arxiv.org/abs/2410.{i:05d}v1' for i in range(n_documents)],
+        'updated': [p.strftime('%Y-%m-%d') for p in published],
+        'published_ts': published,
+        'published': [p.strftime('%Y-%m-%d') for p in published],
+        'title': titles,
+        'authors': [[f'Author {a}' for a in rng.integers(0, 1000, 3)] for _ in range(n_documents)],
+        'categories': [['cs.AI', str(rng.choice(['cs.CL', 'cs.LG', 'stat.ML']))] for _ in range(n_documents)],
+        'comment': None,
+        'primary_category': 'cs.AI',
+        'journal_ref': None,
+        'summary': [random_text(rng, 150) for _ in range(n_documents)],
+        'doi': None,
+        'submitted': [p.strftime('%Y-%m-%d') for p in published],
+        'date': [p.strftime('%Y-%m-%d') for p in published],
+        'title_embeddings': list(embeddings.astype(np.float64)),
+    })
+    documents['result'] = documents['entry_id']
+    documents[['click', 'expand', 'impress']] = rng.poisson(1.0, (n_documents, 3)).astype(float)
+    queries = [random_text(rng, 3) for _ in range(n_users)]
+    user_titles = [','.join(rng.choice(titles, 3)) for _ in range(n_users)]
+    user_embeddings = {'query': encoder.encode(queries), 'title': encoder.encode(user_titles)}
+    users = pd.DataFrame({
+        'user_id': [f'user{i}' for i in range(n_users)],
+        'query': queries,
+        'title': user_titles,
+        'user_query_embeddings': list(user_embeddings['query'].astype(np.float64)),
+        'user_title_embeddings': list(user_embeddings['title'].astype(np.float64)),
+        'date_ts': today,
+    })
+    users.to_parquet(paths['user'])
+    for key, matrix in user_embeddings.items():
+        save_embeddings(paths[f'user_{key}_embeddings'], matrix)
+    documents.to_parquet(paths['documents'])
+    save_embeddings(paths['document_embeddings'], embeddings)
+    IVFIndex.build(embeddings).save(paths['document_index'])
+    return paths
+
+
+def log_traffic(log_dir, user_ids):
+    """
+    Requests of the frontend for the events in its logs. User ids of the logs are mapped onto the synthetic
+    users, keeping how often users come back.
+    """
+    traffic = []
+    for path in sorted(glob.glob(os.path.join(log_dir, '*.log'))):
+        with open(path, errors='replace') as f:
+            for line in f:
+                match = LOG_PATTERN.search(line)
+                if not match:
+                    continue
+                event = json.loads(match.group())
+                user_id = user_ids[int(hashlib.sha1(str(event.get('user_id')).encode()).hexdigest()[:8], 16)
+                                   % len(user_ids)]
+                if event.get('action') == 'recommendations':
+                    traffic.append({'method': 'GET', 'path': '/recommendations', 'params': {'user_id': user_id}})
+                elif event.get('action') == 'search' and event.get('query'):
+                    traffic.append({'method': 'POST', 'path': '/rerank', 'query': event['query']})
+    return traffic
+
+
+def synthetic_traffic(n_requests, user_ids, rerank_share=0.2, seed=0):
+    """
+    Requests of users drawn with a long-tailed popularity, some of them searches
+    """
+    rng = np.random.default_rng(seed)
+    traffic = []
+    for _ in range(n_requests):
+        if rng.random() < rerank_share:
+            traffic.append({'method': 'POST', 'path': '/rerank', 'query': random_text(rng, 3)})
+        else:
+            user_id = user_ids[min(int(rng.zipf(1.5)) - 1, len(user_ids) - 1)]
+            traffic.append({'method': 'GET', 'path': '/recommendations', 'params': {'user_id': user_id}})
+    return traffic
+
+
+def load_traffic(path):
+    """
+    Requests from a jsonl file, one {"method", "path", "params" or "json"} object per line.
+    /rerank requests may give only a "query", the results to rerank are then drawn from the corpus.
+    """
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def complete_request(request, documents, rng, n_results=10):
+    if request['path'] == '/rerank' and 'json' not in request:
+        rows = rng.choice(len(documents), min(n_results, len(documents)), replace=False)
+        request = dict(request, json={'result_ids': documents['entry_id'].iloc[rows].tolist(),
+                                      'titles': documents['title'].iloc[rows].tolist(),
+                                      'query': request['query']})
+    return request
+
+
+def set_up_service(paths, encoder, scoring_model_path=None):
+    """
+    Serving state of the app for a generated corpus, bypassing the startup of the service
+    """
+    fd.local_file_paths.update(paths)
+    config = service.config['ranking_service']
+    corpus = Corpus.load(config)
+    # the generated files must be served as the preprocessing would have them served, not silently replaced
+    if config.get('mmap_embeddings', True) and load_embedding_sidecar(config, paths['documents']) is None:
+        raise RuntimeError(f'Embedding file {paths["document_embeddings"]} was rejected, remove '
+                           f'{os.path.dirname(paths["documents"])} to generate the data again')
+    if config.get('candidate_retrieval', {}).get('index') == 'ivf' and not isinstance(corpus.candidate_index, IVFIndex):
+        raise RuntimeError(f'Candidate index {paths["document_index"]} was rejected, remove '
+                           f'{os.path.dirname(paths["documents"])} to generate the data again')
+    if scoring_model_path and os.path.exists(scoring_model_path):
+        scorer = load_scorer(scoring_model_path)
+    else:
+        scorer = LinearScorer([1.0, 1.0], 0.0)
+    service.query_cache.clear()
+    service.title_cache.clear()
+    service.encoder.model = encoder
+    recommender = RecommendationModel(service.encoder, scorer, service.query_cache, service.title_cache,
+                                      timer=service.stage_timer)
+    # features are served directly from the generated file, their timestamps are not checked against the ttl
+    features = FeatureServer(ParquetFeatures.load(ttl=None), service.feature_cache, corpus.version)
+    service.reloader.state = ServingState(corpus, recommender, corpus.version, features)
+    service.startup['phase'] = 'ready'
+    return corpus
+
+
+async def replay(traffic, concurrency):
+    """
+    Send the requests with concurrent clients, returns the latencies in seconds and errors per endpoint,
+    and the total time
+    """
+    latencies, errors = {}, {}
+    queue = asyncio.Queue()
+    for request in traffic:
+        queue.put_nowait(request)
+
+    async def client(http):
+        while not queue.empty():
+            request = queue.get_nowait()
+            start = time.perf_counter()
+            response = await http.request(request['method'], request['path'], params=request.get('params'),
+                                          json=request.get('json'))
+            latency = time.perf_counter() - start
+            latencies.setdefault(request['path'], []).append(latency)
+            if response.status_code != 200:
+                errors[request['path']] = errors.get(request['path'], 0) + 1
+
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark', timeout=None) as http:
+        start = time.perf_counter()
+        await asyncio.gather(*(client(http) for _ in range(concurrency)))
+        total = time.perf_counter() - start
+    return latencies, errors, total
+
+
+async def check_metrics(caches=('result', 'user_features', 'query_embedding', 'title_embedding')):
+    """
+    Scrape /metrics and fail if a metric could not be rendered or the cache lookups are missing
+    """
+    transport = httpx.ASGITransport(app=service.app)
+    async with httpx.AsyncClient(transport=transport, base_url='http://benchmark') as http:
+        response = await http.get('/metrics')
+    response.raise_for_status()
+    lines = response.text.splitlines()
+    unavailable = [line for line in lines if line.startswith('# ') and ' unavailable: ' in line]
+    samples = [f'cache_lookups_total{{cache="{cache}",result="{result}"}}' for cache in caches
+               for result in ['hit', 'miss']]
+    missing = [sample for sample in samples if not any(line.startswith(sample + ' ') for line in lines)]
+    if unavailable or missing:
+        raise RuntimeError(f'Metrics unavailable: {unavailable}, missing: {missing}')
+
+
+def summarize(latencies, errors, total):
+    results = {}
+    for path, values in sorted(latencies.items()):
+        ms = np.array(values) * 1000
+        results[path] = {'requests': len(values), 'errors': errors.get(path, 0),
+                         'throughput': len(values) / total,
+                         'p50': float(np.percentile(ms, 50)), 'p95': float(np.percentile(ms, 95)),
+                         'p99': float(np.percentile(ms, 99))}
+    return results
+
+
+def print_results(results, baseline=None, tolerance=0.1):
+    """
+    Print results, and their change against the baseline. Returns the regressions beyond the tolerance.
+    """
+    regressions = []
+    print(f'{"corpus":>10} {"endpoint":<18} {"requests":>8} {"errors":>6} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} '
+          f'{"p99 ms":>8}')
+    for size, endpoints in results.items():
+        for path, r in endpoints.items():
+            print(f'{size:>10} {path:<18} {r["requests"]:>8} {r["errors"]:>6} {r["throughput"]:>8.1f} {r["p50"]:>8.2f} '
+                  f'{r["p95"]:>8.2f} {r["p99"]:>8.2f}')
+            b = (baseline or {}).get(size, {}).get(path)
+            if b is None:
+                continue
+            changes = {key: r[key] / b[key] - 1 for key in ['throughput', 'p50', 'p95', 'p99'] if b[key] > 0}
+            print(f'{"":>10} {"vs. baseline":<18} {"":>8} {"":>6} '
+                  + ' '.join(f'{changes.get(key, 0):>+8.1%}' for key in ['throughput', 'p50', 'p95', 'p99']))
+            if changes.get('throughput', 0) < -tolerance or changes.get('p95', 0) > tolerance:
+                regressions.append((size, path))
+    return regressions
+
+
+async def run(args):
+    encoder = HashingEncoder(args.dim) if args.encoder == 'hashing' else load_model(
+        os.path.join(utils.base_folder(), service.config['ranking_service']['model_path']),
+        service.config.get('embedding_backend', {}))
+    scoring_model_path = None if args.synthetic_scoring_model else service.scoring_model_path
+    if args.no_result_cache:
+        service.result_cache.maxsize = 0
+    service.encoder.start()
+    rng = np.random.default_rng(args.seed)
+    results = {}
+    try:
+        for n_documents in args.documents:
+            paths = generate_data(n_documents, args.users, args.dim, args.seed)
+            corpus = set_up_service(paths, encoder, scoring_model_path)
+            user_ids = [f'user{i}' for i in range(args.users)]
+            if args.traffic:
+                traffic = load_traffic(args.traffic)
+            elif args.logs:
+                traffic = log_traffic(args.logs, user_ids)
+            else:
+                traffic = synthetic_traffic(args.requests, user_ids, seed=args.seed)
+            traffic = [complete_request(request, corpus.documents, rng) for request in traffic[:args.requests]]
+            if args.save_traffic:
+                with open(args.save_traffic, 'w') as f:
+                    f.writelines(json.dumps(request) + '\n' for request in traffic)
+            # warm up, e.g. lazily initialized parts of the app and numpy
+            await replay(traffic[:args.concurrency], args.concurrency)
+            print(f'Replaying {len(traffic)} requests against {n_documents} documents')
+            results[str(n_documents)] = summarize(*await replay(traffic, args.concurrency))
+            await check_metrics()
+    finally:
+        await service.encoder.stop()
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--documents', type=int, nargs='+', default=[10000], help='corpus sizes to benchmark')
+    parser.add_argument('--users', type=int, default=1000)
+    parser.add_argument('--dim', type=int, default=768, help='embedding dimension')
+    parser.add_argument('--requests', type=int, default=2000, help='maximum number of requests per corpus size')
+    parser.add_argument('--concurrency', type=int, default=8, help='concurrent clients')
+    parser.add_argument('--logs', help='folder of frontend logs to derive the traffic from, e.g. ../data/frontend')
+    parser.add_argument('--traffic', help='jsonl file of requests to replay')
+    parser.add_argument('--save-traffic', help='write the replayed requests to a jsonl file')
+    parser.add_argument('--encoder', choices=['hashing', 'model'], default='hashing',
+                        help='hashing stand-in or the configured embedding model')
+    parser.add_argument('--synthetic-scoring-model', action='store_true',
+                        help='score with fixed weights instead of the configured scoring model')
+    parser.add_argument('--no-result-cache', action='store_true', help='compute every recommendation')
+    parser.add_argument('--baseline', help='json file of results to compare to')
+    parser.add_argument('--save-baseline', help='write the results to a json file')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='relative drop of throughput or increase of p95 latency reported as regression')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    results = asyncio.run(run(args))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    regressions = print_results(results, baseline, args.tolerance)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f'Regressions: {regressions}')
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -12,10 +12,14 @@ from feast import (
     Field,
     FileSource,
 )
-from feast.types import Float32, Float64, Int64, String
+from feast.types import Array, Float32, Float64, Int64, String
 
 local_file_paths = {'user': '../feature_store/data/latest_user_features.parquet',
-                    'documents': '../feature_store/data/latest_document_features.parquet'}
+                    'documents': '../feature_store/data/latest_document_features.parquet',
+                    'document_embeddings': '../feature_store/data/latest_document_embeddings.npy',
+                    'document_index': '../feature_store/data/latest_document_index.npz',
+                    'user_query_embeddings': '../feature_store/data/latest_user_query_embeddings.npy',
+                    'user_title_embeddings': '../feature_store/data/latest_user_title_embeddings.npy'}
 
 # Define an entity for the driver. You can think of an entity as a primary key used to
 # fetch features.
@@ -52,6 +56,8 @@ user_stats_fv = FeatureView(
     schema=[
         Field(name="query", dtype=String, description="Searched queries"),
         Field(name="title", dtype=String, description="Results with interactions"),
+        Field(name="user_query_embeddings", dtype=Array(Float64), description="Embedding of searched queries"),
+        Field(name="user_title_embeddings", dtype=Array(Float64), description="Embedding of results with interactions"),
     ],
     online=True,
     source=user_stats_source
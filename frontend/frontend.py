@@ -3,6 +3,7 @@ import json
 import streamlit as st
 import arxiv
 import requests
+from urllib.parse import quote
 from types import SimpleNamespace
 from streamlit.logger import get_logger
 import webbrowser
@@ -42,12 +43,28 @@ def search_arxiv(query):
 
 def get_recommendation(backend, user_id):
     endpoint = f"{backend}/recommendations?"
-    params = {'user_id':user_id}
+    # details are fetched when a result is expanded
+    params = {'user_id':user_id, 'fields': 'entry_id,title,authors'}
     results = requests.get(endpoint, params=params).json()
     result_objects = [SimpleNamespace(**result) for result in results]
     return result_objects
 
 
+@st.cache_data
+def get_document(backend, entry_id):
+    endpoint = f"{backend}/documents/{quote(entry_id, safe='')}"
+    return requests.get(endpoint).json()
+
+
+def with_details(backend, result):
+    """
+    Result with all fields, recommendations only come with those needed for the list
+    """
+    if hasattr(result, 'summary'):
+        return result
+    return SimpleNamespace(**get_document(backend, result.entry_id))
+
+
 def rerank(backend, results, query):
     endpoint = f"{backend}/rerank"
     result_map = {result.entry_id: result for result in results}
@@ -80,6 +97,7 @@ def display_result(result, user_id, query):
 
     if on:
         track(user_id=user_id, action='expand', query=query, result=result.entry_id)
+        result = with_details(backend, result)
         with st.expander(result.title, expanded=True):
             st.write(f"**Authors:** {', '.join([str(author) for author in result.authors])}")
             published = result.published if type(result.published) == str else result.published.strftime('%Y-%m-%d')
@@ -0,0 +1,125 @@
+"""
+Concurrent, rate-limited and resumable download of article metadata from the arXiv.
+
+Every (topic, day) partition is fetched by a pool of workers and written to its own parquet file.
+A request rate limiter shared by all workers keeps to the arXiv API etiquette of at most one request every
+three seconds, while requests still overlap with the processing of responses.
+Partition files are written atomically and serve as checkpoints: a run that is interrupted resumes with the
+partitions which are still missing.
+"""
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+import arxiv
+import pandas as pd
+
+MAX_RESULTS = 1000
+
+
+class RateLimiter:
+    """
+    Thread-safe limit of the start of requests to one per interval
+    """
+
+    def __init__(self, interval_s=3.0):
+        self.interval_s = interval_s
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.interval_s
+        time.sleep(start - now)
+
+
+def default_client():
+    # a single page holds all results of a partition, so each fetch is one request to the api
+    return arxiv.Client(page_size=MAX_RESULTS, delay_seconds=3.0, num_retries=3)
+
+
+def fetch(client, topic, day):
+    """
+    Fetch article metadata from the arxiv
+    """
+    qdate = day.strftime("%Y%m%d")
+    date = day.strftime("%Y-%m-%d")
+
+    all_records = []
+    search = arxiv.Search(
+        query=f"cat:{topic} AND submittedDate:[{qdate}0000 TO {qdate}2359]",
+        max_results=MAX_RESULTS,
+        sort_by=arxiv.SortCriterion.SubmittedDate,
+        sort_order=arxiv.SortOrder.Descending
+    )
+    results = client.results(search)
+    for result in results:
+        record = {
+            "entry_id": result.entry_id,
+            "updated": result.updated.strftime("%Y-%m-%d"),
+            "published_ts": result.published,
+            "published": result.published.strftime("%Y-%m-%d"),
+            "title": result.title,
+            "authors": [author.name for author in result.authors],
+            "categories": result.categories,
+            "comment": result.comment,
+            "primary_category": result.primary_category,
+            "journal_ref": result.journal_ref,
+            "summary": result.summary,
+            "doi": result.doi,
+            "submitted": date,
+        }
+        all_records.append(record)
+    df = pd.DataFrame(all_records)
+    return df
+
+
+def partition_path(output_dir, day_str, topic):
+    return os.path.join(output_dir, f"{day_str}_arxiv_{topic}.parquet")
+
+
+def is_downloaded(output_dir, day_str, topic):
+    """
+    A partition is complete if its file exists, or the day was downloaded for all topics at once by earlier versions
+    """
+    return os.path.exists(partition_path(output_dir, day_str, topic)) \
+        or os.path.exists(os.path.join(output_dir, f"{day_str}_arxiv.parquet"))
+
+
+def fetch_partitions(topics, days, output_dir, download_all=False, client_factory=default_client,
+                     rate_limiter=None, max_workers=4):
+    """
+    Fetch all missing (topic, day) partitions concurrently, each worker thread with its own client.
+    Returns the partitions which failed, to be fetched by the next run.
+    """
+    rate_limiter = rate_limiter or RateLimiter()
+    local = threading.local()
+
+    def fetch_partition(topic, day):
+        if not hasattr(local, 'client'):
+            local.client = client_factory()
+        rate_limiter.wait()
+        df = fetch(local.client, topic, day)
+        path = partition_path(output_dir, day.strftime("%Y-%m-%d"), topic)
+        df.to_parquet(f'{path}.tmp', engine="pyarrow")
+        os.replace(f'{path}.tmp', path)
+        return len(df)
+
+    partitions = [(topic, day) for day in days for topic in topics
+                  if download_all or not is_downloaded(output_dir, day.strftime("%Y-%m-%d"), topic)]
+    print(f'Fetching {len(partitions)} partitions, {len(days) * len(topics) - len(partitions)} already downloaded')
+    failed = []
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = {pool.submit(fetch_partition, topic, day): (topic, day) for topic, day in partitions}
+        for future in as_completed(futures):
+            topic, day = futures[future]
+            try:
+                print(f"Loaded {future.result()} records for topic {topic} on day {day}")
+            except Exception as e:
+                print(f"Fetching topic {topic} on day {day} failed: {e!r}")
+                failed.append((topic, day))
+    return failed
@@ -1,73 +1,23 @@
 import os
 import sys
 import datetime
-import arxiv
 import pandas as pd
-import re
-import json
 
 sys.path.append('..')
 import utils
+from scoring_model.model_utils import embedding_matrix
+from scoring_model.candidate_index import IVFIndex
+from scoring_model.quantization import save_embeddings
+from scoring_model.embedding_store import EmbeddingStore
+from arxiv_ingestion import RateLimiter, fetch_partitions
+from log_ingestion import ingest_logs
+from event_store import EVENTS_DIR
+from feature_aggregation import WindowAggregates
 
 OUTPUT_DIR = os.path.join(utils.base_folder(), "data", "preprocessing")
 FS_DIR = os.path.join(utils.base_folder(), "feature_store", "data")
 LOG_DIR = os.path.join(utils.base_folder(), "data", "frontend")
-
-
-def fetch(client, topic, day):
-    """
-    Fetch article metadata from the arxiv
-    """
-    qdate = day.strftime("%Y%m%d")
-    date = day.strftime("%Y-%m-%d")
-
-    all_records = []
-    search = arxiv.Search(
-        query=f"cat:{topic} AND submittedDate:[{qdate}0000 TO {qdate}2359]",
-        max_results=1000,
-        sort_by=arxiv.SortCriterion.SubmittedDate,
-        sort_order=arxiv.SortOrder.Descending
-    )
-    results = client.results(search)
-    for result in results:
-        record = {
-            "entry_id": result.entry_id,
-            "updated": result.updated.strftime("%Y-%m-%d"),
-            "published_ts": result.published,
-            "published": result.published.strftime("%Y-%m-%d"),
-            "title": result.title,
-            "authors": [author.name for author in result.authors],
-            "categories": result.categories,
-            "comment": result.comment,
-            "primary_category": result.primary_category,
-            "journal_ref": result.journal_ref,
-            "summary": result.summary,
-            "doi": result.doi,
-            "submitted": date,
-        }
-        all_records.append(record)
-    df = pd.DataFrame(all_records)
-    return df
-
-
-def parse_logs(day):
-    """
-    Parse dictionary part in lines in log files to a dataframe.
-    Neglect duplicates from streamlit reloading the site.
-    """
-    log_files = [os.path.join(LOG_DIR, f) for f in os.listdir(LOG_DIR) if f.endswith('.log') and day in f]
-    LOG_PATTERN = r'\{.+?\}'
-    logs = []
-    for log_file in log_files:
-        with open(log_file, 'r') as f:
-            for line in f:
-                match = re.search(LOG_PATTERN, line)
-                if match:
-                    data = json.loads(match.group())
-                    logs.append(data)
-    if logs:
-        return pd.DataFrame(logs).drop_duplicates()
-    return
+AGGREGATES_DIR = os.path.join(OUTPUT_DIR, "aggregates")
 
 
 def prepare_raw_data(download_all, config, date_str: str):
@@ -79,30 +29,19 @@ def prepare_raw_data(download_all, config, date_str: str):
     os.makedirs(OUTPUT_DIR, exist_ok=True)
     topics = config['preprocessing']['topics']
     num_days = config['preprocessing']['history_days']
-    for i in range(num_days):
-        day_str = utils.date_to_str(date - datetime.timedelta(days=i))
-        log_data = parse_logs(day_str)
-        if log_data is not None:
-            output_file = os.path.join(OUTPUT_DIR, f"{day_str}_logs.parquet")
-            log_data.to_parquet(output_file)
-
-    client = arxiv.Client()
-    for i in range(num_days):
-        day = date - datetime.timedelta(days=i)
-        output_file = os.path.join(OUTPUT_DIR, f"{utils.date_to_str(day)}_arxiv.parquet")
-        if os.path.exists(output_file) and not download_all:
-            print(f'Data for {day} already downloaded')
-            continue
-        dfs = []
-        for topic in topics:
-            print(f"Fetching documents for topic: {topic} on day {day}")
-            df = fetch(client, topic, day)
-            dfs.append(df)
-        dfs = pd.concat(dfs)
-
-        dfs.to_parquet(output_file, engine="pyarrow")
-        print(f"Loaded {len(dfs)} records for date {day}")
-        print(f"Data saved to {output_file}")
+    log_config = config['preprocessing'].get('logs', {})
+    ingest_logs(LOG_DIR, EVENTS_DIR, os.path.join(OUTPUT_DIR, 'log_ingestion_state.json'),
+                workers=log_config.get('workers', 4), chunk_bytes=log_config.get('chunk_mb', 16) * 2 ** 20,
+                dedup_window_s=log_config.get('dedup_window_s', 300),
+                partition_by_action=log_config.get('partition_by_action', False), legacy_dir=OUTPUT_DIR)
+
+    arxiv_config = config['preprocessing'].get('arxiv', {})
+    days = [date - datetime.timedelta(days=i) for i in range(num_days)]
+    failed = fetch_partitions(topics, days, OUTPUT_DIR, download_all,
+                              rate_limiter=RateLimiter(arxiv_config.get('request_interval_s', 3.0)),
+                              max_workers=arxiv_config.get('max_workers', 4))
+    if failed:
+        print(f'{len(failed)} partitions could not be fetched, run again to resume')
 
 
 def load_files(num_days, fid, date_str, include_date=True):
@@ -110,14 +49,13 @@ def load_files(num_days, fid, date_str, include_date=True):
     Load data from the last few days from preprocessed files
     """
     data = []
-    files = os.listdir(OUTPUT_DIR)
-    files.sort()
+    files = sorted(f for f in os.listdir(OUTPUT_DIR) if fid in f and f.endswith('.parquet'))
+    # there may be several files per day, e.g. one per topic
     if include_date:
-        files = [f for f in files if f[0:10] <= date_str and fid in f]
-        files = [f for f in files[-num_days + 1:]]
+        dates = sorted({f[0:10] for f in files if f[0:10] <= date_str})[-num_days + 1:]
     else:
-        files = [f for f in files if f[0:10] < date_str and fid in f]
-        files = [f for f in files[-num_days:]]
+        dates = sorted({f[0:10] for f in files if f[0:10] < date_str})[-num_days:]
+    files = [f for f in files if f[0:10] in dates]
 
     print(f'Loading from files {files}')
     for f in files:
@@ -135,46 +73,75 @@ def prepare_features(config, date_str):
     """
     history_days = config['preprocessing']['history_days']
     print('Preparing features')
-    logs = load_files(history_days, 'logs', date_str, include_date=False)
-    logs['click'] = logs['action'] == 'click'
-    logs['expand'] = logs['action'] == 'expand'
-    logs['impress'] = logs['action'] == 'impress'
-    log_doc_features = logs.groupby(['result']).agg({'click':'sum', 'expand': 'sum', 'impress': 'sum'}).reset_index()
-    documents = load_files(history_days, 'arxiv', date_str)
+    # interactions of the days before date_str
+    start_date = utils.date_to_str(utils.str_to_date(date_str) - datetime.timedelta(days=history_days))
+    aggregates = WindowAggregates(AGGREGATES_DIR).update(start_date, date_str)
+    log_doc_features = aggregates['document_actions']
+    # articles cross-listed in several topics are fetched once per topic
+    documents = load_files(history_days, 'arxiv', date_str).drop_duplicates(subset='entry_id')
 
     print('Preparing document features')
-    model = utils.load_embedding_model(config)
+    store_config = config['preprocessing'].get('embedding_store', {})
+    store_path = os.path.join(utils.base_folder(), store_config.get('path', 'data/preprocessing/embedding_store'))
+    if config.get('embedding_backend', {}).get('quantize', False):
+        # whether the model runs quantized is only known once it is loaded and passed the parity check
+        model = utils.load_embedding_model(config)
+        store = EmbeddingStore(store_path, utils.embedding_model_name(config, model), lambda: model)
+    else:
+        store = EmbeddingStore(store_path, utils.embedding_model_name(config),
+                               lambda: utils.load_embedding_model(config))
+    used_keys = []
 
-    def column_to_embeddings(column_list, model):
-        embeddings = model.encode(column_list)
+    def column_to_embeddings(ids, column_list):
+        used_keys.extend(store.key(id, text) for id, text in zip(ids, column_list))
+        embeddings = store.encode(ids, column_list)
         embeddings = [embeddings[i, :].tolist() for i in range(len(column_list))]
         return embeddings
 
-    documents['title_embeddings'] = column_to_embeddings(documents["title"].tolist(), model)
+    documents['title_embeddings'] = column_to_embeddings(documents['entry_id'].tolist(), documents["title"].tolist())
     documents = pd.merge(documents, log_doc_features, left_on='entry_id', right_on='result', how='left')
     documents[['click', 'expand', 'impress']] = documents[['click', 'expand', 'impress']].fillna(0)
 
     documents.to_parquet(os.path.join(OUTPUT_DIR, f'{date_str}_document_features.parquet'))
     documents.to_parquet(os.path.join(FS_DIR, f'latest_document_features.parquet'))
+    document_embeddings = embedding_matrix(documents['title_embeddings'])
+    save_embeddings(os.path.join(FS_DIR, 'latest_document_embeddings.npy'), document_embeddings,
+                    config['preprocessing'].get('embedding_dtype', 'float32'))
+    print('Building candidate index')
+    index_config = config['preprocessing'].get('candidate_index', {})
+    index = IVFIndex.build(document_embeddings, n_lists=index_config.get('n_lists'), n_iter=index_config.get('n_iter', 10))
+    index.save(os.path.join(FS_DIR, 'latest_document_index.npz'))
     print('Preparing user features')
-    logs = pd.merge(logs, documents[['entry_id', 'title']], left_on='result', right_on='entry_id', how='left')
-    user_features = logs.groupby(['user_id']).agg({'query':list, 'title': list}).reset_index()
+    user_titles = pd.merge(aggregates['user_results'], documents[['entry_id', 'title']], left_on='result',
+                           right_on='entry_id', how='left')
+    # every user has rows in both tables, with a missing query or result for events without one
+    user_features = pd.concat([aggregates['user_queries'].groupby('user_id')['query'].agg(list),
+                               user_titles.groupby('user_id')['title'].agg(list)], axis=1)
+    user_features = user_features.rename_axis('user_id').reset_index()
 
     def compress_list(l):
         if l is None:
             return ''
-        l = set(l)
-        l = [i for i in l if type(i) == str and len(l) > 0]
+        # sorted, so unchanged interactions give the same text (and stored embedding) every day
+        l = sorted(set(i for i in l if type(i) == str))
         s = ','.join(l)
         return s
 
     user_features['query'] = user_features['query'].apply(compress_list)
-    user_features['user_query_embeddings'] = column_to_embeddings(user_features["query"].tolist(), model)
+    user_features['user_query_embeddings'] = column_to_embeddings(
+        ('query/' + user_features['user_id']).tolist(), user_features["query"].tolist())
     user_features['title'] = user_features['title'].apply(compress_list)
-    user_features['user_title_embeddings'] = column_to_embeddings(user_features["title"].tolist(), model)
+    user_features['user_title_embeddings'] = column_to_embeddings(
+        ('title/' + user_features['user_id']).tolist(), user_features["title"].tolist())
     user_features['date_ts'] = datetime.datetime.strptime(date_str, '%Y-%m-%d')
     user_features.to_parquet(os.path.join(OUTPUT_DIR, f'{date_str}_user_features.parquet'))
     user_features.to_parquet(os.path.join(FS_DIR, f'latest_user_features.parquet'))
+    # for serving user features without the feature store, written after the features they belong to
+    for key in ['query', 'title']:
+        save_embeddings(os.path.join(FS_DIR, f'latest_user_{key}_embeddings.npy'),
+                        embedding_matrix(user_features[f'user_{key}_embeddings']))
+    # embeddings of documents and users which are not in the features any more are dropped eventually
+    store.compact(used_keys, max_shards=store_config.get('max_shards', 8))
 
 
 def main(date, download_all=False):
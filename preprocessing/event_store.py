@@ -0,0 +1,114 @@
+"""
+Columnar store of the user interaction events parsed from the frontend logs.
+
+Events are a parquet dataset partitioned by date, and optionally by action, in hive style:
+    events/date=2024-10-25/[action=click/]<log file>-<offset>.parquet
+User ids, entry ids, actions and queries repeat a lot and are dictionary encoded.
+Reads are scans of the dataset, which only open the partitions of the requested dates and only decode
+the requested columns.
+"""
+
+import glob
+import os
+import sys
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+
+sys.path.append('..')
+import utils
+
+EVENTS_DIR = os.path.join(utils.base_folder(), "data", "preprocessing", "events")
+
+STRING_IDS = pa.dictionary(pa.int32(), pa.string())
+SCHEMA = pa.schema([('user_id', STRING_IDS), ('action', STRING_IDS), ('result', STRING_IDS),
+                    ('query', STRING_IDS)])
+
+
+class PartitionWriter:
+    """
+    Writes the events parsed from one source into a file per partition they belong to.
+    Files are written under a hidden name, which dataset scans skip, and renamed once complete.
+    """
+
+    def __init__(self, events_dir, name, partition_by_action=False):
+        self.events_dir = events_dir
+        self.name = name
+        self.partition_by_action = partition_by_action
+        self.schema = pa.schema([f for f in SCHEMA if not (partition_by_action and f.name == 'action')])
+        self.writers = {}
+
+    def write(self, table, date):
+        """
+        Write a table of events of one date, as a row group of each partition file
+        """
+        table = table.cast(SCHEMA)
+        if not self.partition_by_action:
+            self.writer(f'date={date}').write_table(table)
+            return
+        actions = table['action'].cast(pa.string())
+        for action in pc.unique(actions).to_pylist():
+            rows = table.filter(pc.equal(actions, action)).drop_columns(['action'])
+            self.writer(f'date={date}/action={action}').write_table(rows)
+
+    def writer(self, partition):
+        if partition not in self.writers:
+            os.makedirs(os.path.join(self.events_dir, partition), exist_ok=True)
+            self.writers[partition] = pq.ParquetWriter(self.path(partition, '.tmp'), self.schema)
+        return self.writers[partition]
+
+    def path(self, partition, temporary=''):
+        name = f'.{self.name}.parquet{temporary}' if temporary else f'{self.name}.parquet'
+        return os.path.join(self.events_dir, partition, name)
+
+    def close(self):
+        for partition, writer in self.writers.items():
+            writer.close()
+            os.replace(self.path(partition, '.tmp'), self.path(partition))
+        partitions, self.writers = list(self.writers), {}
+        return partitions
+
+
+def source_files(events_dir, name_pattern):
+    """
+    Files of all partitions with names matching a glob pattern
+    """
+    return glob.glob(os.path.join(events_dir, 'date=*', '**', f'{name_pattern}.parquet'), recursive=True)
+
+
+def date_files(date, events_dir=EVENTS_DIR):
+    """
+    Complete files of the partitions of a date
+    """
+    return sorted(glob.glob(os.path.join(events_dir, f'date={date}', '**', '[!.]*.parquet'), recursive=True))
+
+
+def partitioning(events_dir):
+    fields = [('date', pa.string())]
+    if glob.glob(os.path.join(events_dir, 'date=*', 'action=*')):
+        fields.append(('action', pa.string()))
+    return ds.partitioning(pa.schema(fields), flavor='hive')
+
+
+def load_events(start_date=None, end_date=None, columns=None, events_dir=EVENTS_DIR):
+    """
+    Events from start_date up to (excluding) end_date, with the requested columns and the date.
+    Events logged more than once on a day, e.g. again when the site is reloaded or in several log files,
+    are only returned once. Ids are categorical columns.
+    """
+    columns = list(dict.fromkeys((columns or SCHEMA.names) + ['date']))
+    if not glob.glob(os.path.join(events_dir, 'date=*')):
+        return pd.DataFrame(columns=columns)
+    dataset = ds.dataset(events_dir, format='parquet', partitioning=partitioning(events_dir))
+    date_filter = None
+    if start_date is not None:
+        date_filter = ds.field('date') >= start_date
+    if end_date is not None:
+        end_filter = ds.field('date') < end_date
+        date_filter = end_filter if date_filter is None else date_filter & end_filter
+    events = dataset.to_table(columns=SCHEMA.names + ['date'], filter=date_filter).to_pandas().drop_duplicates()
+    print(f'Loaded {len(events)} events from {start_date} to {end_date}')
+    return events[columns].reset_index(drop=True)
@@ -0,0 +1,160 @@
+"""
+Aggregates of the user interaction events over the rolling window of days the features are based on.
+
+Each day is aggregated once into partial aggregates, which are kept in a folder per day. They are count
+tables, e.g. the number of clicks per document, or the number of days a user searched for a query.
+The aggregates of the whole window are kept as well, and updated by adding the partial aggregates of new
+days and subtracting those of days which dropped out of the window, so the daily work does not grow with
+the length of the window. Days whose events changed since they were aggregated (e.g. logs ingested late)
+are subtracted and added again.
+"""
+
+import datetime
+import glob
+import hashlib
+import json
+import os
+import shutil
+import sys
+
+import pandas as pd
+
+sys.path.append('..')
+import utils
+from event_store import EVENTS_DIR, date_files, load_events
+
+# count tables, by their key columns
+TABLES = {
+    'document_actions': ['result'],
+    'user_queries': ['user_id', 'query'],
+    'user_results': ['user_id', 'result'],
+}
+ACTIONS = ['click', 'expand', 'impress']
+
+
+def daily_aggregates(events):
+    """
+    Partial aggregates of the events of one day
+    """
+    events = events[['user_id', 'action', 'result', 'query']].astype(object)
+    for action in ACTIONS:
+        events[action] = (events['action'] == action).astype('int64')
+    return {
+        'document_actions': events.groupby('result')[ACTIONS].sum().reset_index(),
+        'user_queries': events[['user_id', 'query']].drop_duplicates().assign(days=1),
+        'user_results': events[['user_id', 'result']].drop_duplicates().assign(days=1),
+    }
+
+
+def combine(aggregates, other, sign=1):
+    """
+    Sum (or difference, for sign=-1) of aggregates, without keys whose counts are all zero
+    """
+    combined = {}
+    for name, keys in TABLES.items():
+        table = other[name]
+        if sign != 1:
+            counts = table.columns.difference(keys)
+            table = table.assign(**{c: sign * table[c] for c in counts})
+        table = pd.concat([aggregates[name], table])
+        table = table.groupby(keys, dropna=False, sort=False).sum().reset_index()
+        counts = table.columns.difference(keys)
+        combined[name] = table[(table[counts] != 0).any(axis=1)].reset_index(drop=True)
+    return combined
+
+
+class WindowAggregates:
+
+    def __init__(self, folder, events_dir=EVENTS_DIR):
+        self.folder = folder
+        self.events_dir = events_dir
+        os.makedirs(os.path.join(folder, 'daily'), exist_ok=True)
+
+    def update(self, start_date, end_date):
+        """
+        Aggregates of the events from start_date up to (excluding) end_date
+        """
+        start, end = utils.str_to_date(start_date), utils.str_to_date(end_date)
+        days = [utils.date_to_str(start + datetime.timedelta(days=i)) for i in range((end - start).days)]
+        target = {day: utils.file_version(*files) for day in days if (files := date_files(day, self.events_dir))}
+        state, aggregates = self.load_window()
+        removed = [day for day, version in state.items() if target.get(day) != version]
+        added = [day for day, version in target.items() if state.get(day) != version]
+        if aggregates is not None and not removed and not added:
+            print(f'Aggregates of {len(target)} days are up to date')
+            return aggregates
+
+        # a partial aggregate can only be subtracted if it is still the one which was added
+        if aggregates is None or len(removed) + len(added) > len(target) \
+                or any(self.daily_version(day) != state[day] for day in removed):
+            print(f'Aggregating {len(target)} days')
+            aggregates = daily_aggregates(pd.DataFrame(columns=['user_id', 'action', 'result', 'query']))
+            for day in target:
+                aggregates = combine(aggregates, self.daily(day, target[day]))
+        else:
+            print(f'Updating aggregates, removing {len(removed)} and adding {len(added)} days')
+            for day in removed:
+                aggregates = combine(aggregates, self.load_daily(day), sign=-1)
+            for day in added:
+                aggregates = combine(aggregates, self.daily(day, target[day]))
+        self.save_window(target, aggregates)
+        return aggregates
+
+    def daily_path(self, day):
+        return os.path.join(self.folder, 'daily', day)
+
+    def daily_version(self, day):
+        path = os.path.join(self.daily_path(day), 'version.json')
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return json.load(f)['version']
+
+    def load_daily(self, day):
+        return {name: pd.read_parquet(os.path.join(self.daily_path(day), f'{name}.parquet')) for name in TABLES}
+
+    def daily(self, day, version):
+        """
+        Partial aggregates of a day, computed from the events unless they are stored for the same events.
+        The version is written last and removed first, so incomplete aggregates are never used.
+        """
+        if self.daily_version(day) == version:
+            return self.load_daily(day)
+        next_day = utils.date_to_str(utils.str_to_date(day) + datetime.timedelta(days=1))
+        aggregates = daily_aggregates(load_events(day, next_day, events_dir=self.events_dir))
+        path = self.daily_path(day)
+        if os.path.exists(os.path.join(path, 'version.json')):
+            os.remove(os.path.join(path, 'version.json'))
+        os.makedirs(path, exist_ok=True)
+        for name, table in aggregates.items():
+            table.to_parquet(os.path.join(path, f'{name}.parquet'), index=False)
+        with open(os.path.join(path, 'version.json'), 'w') as f:
+            json.dump({'version': version}, f)
+        return aggregates
+
+    def load_window(self):
+        """
+        Versions of the aggregated days and the aggregates, ({}, None) if there are none
+        """
+        path = os.path.join(self.folder, 'window.json')
+        if not os.path.exists(path):
+            return {}, None
+        with open(path) as f:
+            state = json.load(f)
+        window_path = os.path.join(self.folder, state['path'])
+        return state['days'], {name: pd.read_parquet(os.path.join(window_path, f'{name}.parquet')) for name in TABLES}
+
+    def save_window(self, days, aggregates):
+        """
+        Window aggregates are written to a new folder, which window.json points to once it is complete
+        """
+        name = 'window-' + hashlib.sha1(json.dumps(days, sort_keys=True).encode()).hexdigest()[:12]
+        os.makedirs(os.path.join(self.folder, name), exist_ok=True)
+        for table_name, table in aggregates.items():
+            table.to_parquet(os.path.join(self.folder, name, f'{table_name}.parquet'), index=False)
+        with open(os.path.join(self.folder, 'window.json.tmp'), 'w') as f:
+            json.dump({'days': days, 'path': name}, f)
+        os.replace(os.path.join(self.folder, 'window.json.tmp'), os.path.join(self.folder, 'window.json'))
+        for path in glob.glob(os.path.join(self.folder, 'window-*')):
+            if os.path.basename(path) != name:
+                shutil.rmtree(path)
@@ -0,0 +1,172 @@
+"""
+Incremental ingestion of the frontend logs into the event store.
+
+For each log file, the byte offset up to which it was parsed is kept in a state file, so every run only parses
+lines appended since the last one. New lines are read in chunks of bounded size, each written as row groups
+of new files <log file>-<offset>.parquet in the partitions of the event store. Naming files by their start offset
+makes a repeated run after a crash overwrite its previous output instead of duplicating it.
+Log files are ingested in parallel processes.
+
+Streamlit logs the same events again when the site is reloaded. Events are deduplicated per day when they are
+read (see load_events). To store fewer of them, an event is already dropped here if the same event was logged
+on the same day within the last dedup_window_s seconds, which only needs the events of that window in memory.
+"""
+
+import datetime
+import glob
+import json
+import os
+import re
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+from event_store import PartitionWriter, source_files
+
+LOG_PATTERN = re.compile(r'\{.+?\}')
+RAW_SCHEMA = pa.schema([('user_id', pa.string()), ('action', pa.string()), ('result', pa.string()),
+                        ('query', pa.string())])
+
+
+class Timestamps:
+    """
+    Seconds (since the start of the calendar) of the timestamp prefix of log lines, e.g. '2024-10-25 18:11:54,666'.
+    Parsed by position, which is much faster than strptime for every line.
+    """
+
+    def __init__(self):
+        self.days = {}
+
+    def __call__(self, line):
+        day = line[0:10]
+        if day not in self.days:
+            try:
+                self.days[day] = datetime.date(int(day[0:4]), int(day[5:7]), int(day[8:10])).toordinal() * 86400
+            except ValueError:
+                return None
+        try:
+            return (self.days[day] + int(line[11:13]) * 3600 + int(line[14:16]) * 60 + int(line[17:19])
+                    + int(line[20:23]) / 1000)
+        except ValueError:
+            return None
+
+
+def parse_lines(lines, recent, dedup_window_s, timestamps, day):
+    """
+    Events in the dictionary part of log lines, without events already logged on the same day within the window,
+    and their dates.
+    Lines without a timestamp are dated to the day of the log file.
+    recent maps events to the time they were first seen, in order, and is updated.
+    """
+    records, dates = [], []
+    for line in lines:
+        line = line.decode('utf-8', errors='replace')
+        match = LOG_PATTERN.search(line)
+        if not match:
+            continue
+        event = match.group()
+        ts = timestamps(line)
+        if ts is not None:
+            while recent and next(iter(recent.values())) < ts - dedup_window_s:
+                recent.popitem(last=False)
+            key = f'{line[0:10]} {event}'
+            if key in recent:
+                continue
+            recent[key] = ts
+        records.append(json.loads(event))
+        dates.append(day if ts is None else line[0:10])
+    return records, dates
+
+
+def ingest_file(path, events_dir, file_state=None, chunk_bytes=16 * 2 ** 20, dedup_window_s=300,
+                partition_by_action=False):
+    """
+    Parse the lines appended to a log file since the offset in its state, returns the new state.
+    A truncated or replaced file is parsed from the start, an incomplete last line is left for the next run.
+    """
+    file_state = file_state or {}
+    stat = os.stat(path)
+    offset = file_state.get('offset', 0)
+    recent = OrderedDict(file_state.get('recent', []))
+    name = os.path.basename(path)[:-len('.log')]
+    if file_state.get('inode') != stat.st_ino or stat.st_size < offset:
+        offset, recent = 0, OrderedDict()
+        for part in source_files(events_dir, f'{glob.escape(name)}-*'):
+            os.remove(part)
+
+    writer = PartitionWriter(events_dir, f'{name}-{offset:012d}', partition_by_action)
+    timestamps = Timestamps()
+    with open(path, 'rb') as f:
+        f.seek(offset)
+        while True:
+            lines = f.readlines(chunk_bytes)
+            complete = bool(lines) and lines[-1].endswith(b'\n')
+            if lines and not complete:
+                lines.pop()
+            if not lines:
+                break
+            offset += sum(len(line) for line in lines)
+            records, dates = parse_lines(lines, recent, dedup_window_s, timestamps, name[0:10])
+            if records:
+                table = pa.Table.from_pylist(records, schema=RAW_SCHEMA)
+                for date in sorted(set(dates)):
+                    writer.write(table.filter(pa.array([d == date for d in dates])), date)
+            if not complete:
+                break
+    partitions = writer.close()
+    if partitions:
+        print(f'Ingested {path} up to byte {offset} into {", ".join(partitions)}')
+    return {'offset': offset, 'inode': stat.st_ino, 'recent': list(recent.items())}
+
+
+def ingest_logs(log_dir, events_dir, state_path, workers=4, chunk_bytes=16 * 2 ** 20, dedup_window_s=300,
+                partition_by_action=False, legacy_dir=None):
+    """
+    Ingest new lines of all log files, in parallel processes. The state is saved after each file.
+    Log files written by earlier versions to legacy_dir are moved into the event store first.
+    """
+    state = {}
+    if os.path.exists(state_path):
+        with open(state_path) as f:
+            state = json.load(f)
+    log_files = sorted(f for f in os.listdir(log_dir) if f.endswith('.log'))
+    if legacy_dir is not None:
+        remove_unpartitioned_logs(legacy_dir, [f for f in log_files if f not in state])
+        migrate_log_files(legacy_dir, events_dir, partition_by_action)
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {pool.submit(ingest_file, os.path.join(log_dir, f), events_dir, state.get(f),
+                               chunk_bytes, dedup_window_s, partition_by_action): f for f in log_files}
+        for future in as_completed(futures):
+            state[futures[future]] = future.result()
+            with open(f'{state_path}.tmp', 'w') as f:
+                json.dump(state, f)
+            os.replace(f'{state_path}.tmp', state_path)
+
+
+def remove_unpartitioned_logs(legacy_dir, new_log_files):
+    """
+    Logs of days parsed in full by earlier versions are replaced, when log files of that day are ingested from the start
+    """
+    for day in {f[0:10] for f in new_log_files}:
+        path = os.path.join(legacy_dir, f'{day}_logs.parquet')
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def migrate_log_files(legacy_dir, events_dir, partition_by_action=False):
+    """
+    Move parsed logs of earlier versions, <day>_logs[-<log file>-<offset>].parquet, into the event store.
+    Parts keep the <log file>-<offset> name, so they are replaced like new files when their log file is reset.
+    """
+    for path in sorted(glob.glob(os.path.join(legacy_dir, '*_logs*.parquet'))):
+        file_name = os.path.basename(path)[:-len('.parquet')]
+        day = file_name[0:10]
+        writer = PartitionWriter(events_dir, file_name[len(f'{day}_logs-'):] or file_name, partition_by_action)
+        for batch in pq.ParquetFile(path).iter_batches(columns=RAW_SCHEMA.names):
+            writer.write(pa.Table.from_batches([batch]), day)
+        writer.close()
+        os.remove(path)
+        print(f'Moved {path} into {events_dir}')
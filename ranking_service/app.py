@@ -8,35 +8,41 @@ Fast text application
 """
 
 import uvicorn
+import fcntl
+import gc
 import os
 import sys
+import threading
+import time
+import traceback
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import asynccontextmanager, contextmanager
 from typing import List, Optional
-import pandas as pd
+import numpy as np
 
-from fastapi import FastAPI, Query
-from pydantic import BaseModel
+from fastapi import FastAPI, HTTPException, Query, Request, Response
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
+from starlette.routing import Match
+from pydantic import BaseModel, Field, model_validator
 import datetime
 from feast import FeatureStore
 
 sys.path.append('..')
 import utils
 from feature_store import feature_definitions as fd
-from scoring_model.model_utils import RecommendationModel, load_model, load_scoring_model
-
-
-class Document(BaseModel):
-    entry_id: str
-    updated: Optional[str] = None
-    published: Optional[str] = None
-    title: str
-    authors: Optional[List[str]] = None
-    categories: Optional[List[str]] = None
-    comment: Optional[str] = None
-    summary: Optional[str] = None
-    primary_category: Optional[str] = None
-    doi: Optional[str] = None
-    submitted: Optional[str] = None
-    journal_ref: Optional[str] = None
+from scoring_model.model_utils import RecommendationModel, linear_export_path, load_model, load_scorer
+from scoring_model.embedding_backend import passes_parity_check
+from scoring_model.embedding_cache import EmbeddingCache
+from corpus import Corpus
+from shared_corpus import load_shared_corpus
+from encoding import EncodingScheduler
+from reloader import Reloader, ServingState
+from result_cache import ResultCache
+from feature_serving import FeatureServer, ParquetFeatures
+from documents import Document, dumps, parse_fields
+from metrics import REGISTRY, REQUEST_SECONDS, Gauge, SamplingProfiler, cache_counter, stage_timer
 
 
 class QueryRequest(BaseModel):
@@ -48,81 +54,460 @@ class RerankRequest(BaseModel):
     titles: list[str]
     query: str
 
+    @model_validator(mode='after')
+    def check_titles(self):
+        """
+        One title per result id, as titles are looked up by the position of the id
+        """
+        if len(self.titles) != len(self.result_ids):
+            raise ValueError(f'{len(self.result_ids)} result_ids but {len(self.titles)} titles, one title per id needed')
+        return self
+
+
+class BatchRecommendationRequest(BaseModel):
+    user_ids: list[str]
+    k: int = Field(10, ge=1, le=1000)
+    fields: Optional[str] = None
+    categories: Optional[str] = None
+    since: Optional[datetime.date] = None
+    until: Optional[datetime.date] = None
+
+
+class UserRecommendations(BaseModel):
+    user_id: str
+    documents: list[Document]
+
 
 class FeatureHandler:
+    """
+    Feast feature store of the user features. The worker processes of one server (serve.py, same server_id)
+    share its registry and online store: the first of them to get the lock applies the feature definitions and
+    materializes the current user features, the others only read them.
+    """
 
-    def __init__(self, config):
+    def __init__(self, config, server_id=None):
         self.config = config
+        self.server_id = server_id or uuid.uuid4().hex
+        self.fs_base = os.path.join(utils.base_folder(), 'feature_store')
+        self.lock_path = os.path.join(self.fs_base, 'data', 'materialization.lock')
         self.init_feature_store()
-        self.load_documents()
 
-    def load_documents(self):
+    @contextmanager
+    def materialization(self):
         """
-        Load all documents from disc, including precomputed embeddings.
-        This might be handled by the feature store in combination with a preprocessing service, to preselect
-        candidates for recommendations in a more advanced setup.
+        Exclusive write access to the feature store. Yields False if the current user features were materialized
+        by this server already, the lock file records the server and the version of the user features.
         """
-        self.documents = pd.read_parquet(fd.local_file_paths['documents'])
-
-    def document_features(self):
-        return self.documents.copy()
+        os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+        materialized = f'{self.server_id} {utils.file_version(fd.local_file_paths["user"])}'
+        with open(self.lock_path, 'a+') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            lock.seek(0)
+            if lock.read() == materialized:
+                yield False
+                return
+            yield True
+            lock.seek(0)
+            lock.truncate()
+            lock.write(materialized)
 
     def init_feature_store(self):
         """
         create and update feast feature store
         """
-        fs_base = os.path.join(utils.base_folder(), 'feature_store')
-        self.fstore = FeatureStore(repo_path=fs_base)
-        self.fstore.apply(objects=[fd.user, fd.user_stats_fv, fd.user_stats_source])
-        #  Load features into online store
-        self.fstore.materialize_incremental(end_date=datetime.datetime.now())
-
-    def user_features_from_store(self, user_id):
-        entity_rows = [
-            {
-                "user_id": user_id,
-            },
-        ]
+        self.fstore = FeatureStore(repo_path=self.fs_base)
+        with self.materialization() as write:
+            if not write:
+                return
+            if self.config.get('apply_feature_store', True):
+                self.fstore.apply(objects=[fd.user, fd.user_stats_fv, fd.user_stats_source])
+            #  Load features into online store, only those newer than the last materialization
+            if self.config.get('materialize_on_startup', True):
+                self.fstore.materialize_incremental(end_date=datetime.datetime.now())
+
+    def refresh(self):
+        """
+        Load the latest user features into the online store, including rows older than the last materialization
+        """
+        with self.materialization() as write:
+            if not write:
+                return
+            end_date = datetime.datetime.now()
+            self.fstore.materialize(start_date=end_date - fd.user_stats_fv.ttl, end_date=end_date,
+                                    feature_views=[fd.user_stats_fv.name])
+
+    def user_features_from_store_batch(self, user_ids):
+        """
+        Fetch features of many users from the online store in one lookup. Embeddings are None for users
+        that are not in the store, so they can be computed from the (default) texts instead.
+        """
+        entity_rows = [{"user_id": user_id} for user_id in user_ids]
         features_to_fetch = [
             "user_daily_stats:query",
             "user_daily_stats:title",
+            "user_daily_stats:user_query_embeddings",
+            "user_daily_stats:user_title_embeddings",
         ]
         returned_features = self.fstore.get_online_features(
             features=features_to_fetch,
             entity_rows=entity_rows,
         ).to_dict()
-        defaults = {'query': '', 'title': ''}
-        for key, val in returned_features.items():
-            returned_features[key] = val[0] if val[0] else defaults[key]
-        return returned_features
+        return [
+            {
+                'query': returned_features['query'][i] or '',
+                'title': returned_features['title'][i] or '',
+                'query_embedding': returned_features['user_query_embeddings'][i],
+                'title_embedding': returned_features['user_title_embeddings'][i],
+            }
+            for i in range(len(user_ids))
+        ]
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    encoder.start()
+    threading.Thread(target=start_up, name='startup', daemon=True).start()
+    yield
+    reloader.stop()
+    await encoder.stop()
 
 
-app = FastAPI()
+app = FastAPI(lifespan=lifespan)
 config = utils.load_config()
 
-feature_handler = FeatureHandler(config['ranking_service'])
-embedding_model = load_model(os.path.join(utils.base_folder(), config['ranking_service']["model_path"]))
-scoring_model = load_scoring_model(os.path.join(utils.base_folder(), config['ranking_service']["scoring_model_path"]))
+# set while starting up in the background
+startup = {'phase': 'starting', 'error': None}
+# the same in all worker processes forked from one server (serve.py)
+server_id = uuid.uuid4().hex
+feature_handler = None
+encoding_config = config['ranking_service'].get('encoding', {})
+encoder = EncodingScheduler(None, encoding_config.get('max_batch_size', 64), encoding_config.get('max_wait_ms', 5))
+scoring_model_path = os.path.join(utils.base_folder(), config['ranking_service']["scoring_model_path"])
+# the model and its export for serving, which is used if it is up to date
+scoring_model_files = [scoring_model_path, linear_export_path(scoring_model_path)]
+
+cache_config = config['ranking_service'].get('embedding_cache', {})
+# of the loaded embedding model, set once it is loaded
+model_name = os.path.basename(config['ranking_service']['model_path'])
+title_cache_path = cache_config.get('title_path')
+query_cache = EmbeddingCache(cache_config.get('query_size', 10000), model_name)
+title_cache = EmbeddingCache(cache_config.get('title_size', 100000), model_name,
+                             os.path.join(utils.base_folder(), title_cache_path) if title_cache_path else None)
+feature_config = config['ranking_service'].get('feature_serving', {})
+# feast, or parquet to serve the user feature file directly
+feature_backend = feature_config.get('backend', 'feast')
+# user features of the served version, the cache is flushed when a new version is loaded
+feature_cache = ResultCache(feature_config.get('cache_size', 100000), feature_config.get('cache_ttl_s'))
+# corpus published once for all worker processes (serve.py), None to load it in each
+shared_corpus_path = config['ranking_service'].get('shared_corpus_path')
+
+
+def load_state():
+    """
+    Load corpus, user features and scoring model. The embedding model and the caches are kept across reloads.
+    """
+    if reloader.state is not None and feature_handler is not None:
+        feature_handler.refresh()
+    if shared_corpus_path:
+        corpus = load_shared_corpus(config['ranking_service'], os.path.join(utils.base_folder(), shared_corpus_path))
+    else:
+        corpus = Corpus.load(config['ranking_service'])
+    scorer = load_scorer(scoring_model_path)
+    recommender = RecommendationModel(encoder, scorer, query_cache, title_cache, timer=stage_timer)
+    version = f'{corpus.version}-{utils.file_version(*scoring_model_files)}'
+    backend = feature_handler if feature_backend == 'feast' else ParquetFeatures.load()
+    return ServingState(corpus, recommender, version, FeatureServer(backend, feature_cache, version))
+
+
+reloader = Reloader(load_state,
+                    watched_paths=[fd.local_file_paths['documents'], fd.local_file_paths['document_embeddings'],
+                                   fd.local_file_paths['document_index'], fd.local_file_paths['user'],
+                                   fd.local_file_paths['user_query_embeddings'],
+                                   fd.local_file_paths['user_title_embeddings'], *scoring_model_files],
+                    interval_s=config['ranking_service'].get('reload_interval_s', 60))
+
+
+def start_up():
+    """
+    Load everything needed for serving in phases, while the server already answers health checks.
+    The feature store (unless user features are served without it) and the embedding model are loaded in parallel.
+    The embedding model is only loaded here if it was not preloaded before forking workers.
+    """
+    global feature_handler
+    try:
+        startup['phase'] = 'feature store and embedding model'
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            if feature_backend == 'feast':
+                feature_handler_future = pool.submit(FeatureHandler, config['ranking_service'], server_id)
+            if encoder.model is None:
+                model_future = pool.submit(load_model,
+                                           os.path.join(utils.base_folder(), config['ranking_service']["model_path"]),
+                                           config.get('embedding_backend', {}))
+                encoder.model = model_future.result()
+            if feature_backend == 'feast':
+                feature_handler = feature_handler_future.result()
+        query_cache.model_name = title_cache.model_name = utils.embedding_model_name(config, encoder.model, model_name)
+        startup['phase'] = 'corpus and scoring model'
+        reloader.reload()
+        startup['phase'] = 'warm up'
+        encoder.encode(['warm up'])
+        reloader.start()
+        startup['phase'] = 'ready'
+    except Exception as e:
+        traceback.print_exc()
+        startup['error'] = repr(e)
+        startup['phase'] = 'failed'
+
+
+def preload(workers=1):
+    """
+    Load the embedding model before worker processes are forked (serve.py), so they share its weights
+    copy-on-write. The model does not run before the fork, as the thread pools of torch would not survive it:
+    the parity check of the quantized model runs in a spawned process, the fp32 model is loaded if it fails.
+    Unless configured, the cores are divided among the workers.
+    """
+    model_path = os.path.join(utils.base_folder(), config['ranking_service']["model_path"])
+    backend_config = dict(config.get('embedding_backend', {}))
+    if not backend_config.get('intra_op_threads'):
+        backend_config['intra_op_threads'] = max(1, (os.cpu_count() or 1) // workers)
+    if backend_config.get('quantize', False) and not passes_parity_check(model_path, backend_config):
+        print('Quantized embedding model failed the parity check, preloading fp32')
+        backend_config['quantize'] = False
+    encoder.model = load_model(model_path, backend_config, check_parity=False)
+    # objects loaded so far are never collected, so the garbage collector of the workers does not write to their pages
+    gc.freeze()
+
+
+def serving_state():
+    if startup['phase'] != 'ready':
+        raise HTTPException(status_code=503, detail=f'Service is starting up: {startup["phase"]}')
+    return reloader.state
+
+
+result_cache_config = config['ranking_service'].get('result_cache', {})
+result_cache = ResultCache(result_cache_config.get('size', 10000), result_cache_config.get('ttl_s'))
+FIELDS_DESCRIPTION = 'Comma separated fields of the documents to return, e.g. entry_id,title. All fields by default.'
+
+
+def requested_fields(fields):
+    try:
+        return parse_fields(fields)
+    except ValueError as e:
+        raise HTTPException(status_code=422, detail=str(e))
+
 
-recommender = RecommendationModel(embedding_model, scoring_model)
+CATEGORIES_DESCRIPTION = 'Comma separated categories, e.g. cs.AI,cs.CL. Only documents in any of them are returned.'
+SINCE_DESCRIPTION = 'Only documents published on or after this date are returned.'
+UNTIL_DESCRIPTION = 'Only documents published on or before this date are returned.'
+
+
+def parse_categories(categories):
+    if not categories:
+        return None
+    return tuple(sorted({category.strip() for category in categories.split(',') if category.strip()})) or None
+
+
+def allowed_documents(corpus, categories=None, since=None, until=None):
+    """
+    Boolean mask of the documents passing the filters, None without filters
+    """
+    with stage_timer('filter'):
+        return corpus.metadata_index.mask(categories, since, until)
+
+
+def json_response(content):
+    return Response(content=content, media_type='application/json')
 
 
 @app.post("/rerank")
-def rerank(request: RerankRequest):
+async def rerank(request: RerankRequest):
+    state = serving_state()
     result_ids = request.result_ids
     titles = request.titles
     query = request.query
-    result_ids = recommender.rerank_list(query, result_ids, titles)
+    result_ids = await run_in_threadpool(state.recommender.rerank_list, query, result_ids, titles,
+                                         state.corpus.document_embedding)
 
     return result_ids
 
 
-@app.get("/recommendations")
-def prepare_recommended_documents(user_id: str = Query(...)):
-    sorted_documents = recommender.score(feature_handler.document_features(), feature_handler.user_features_from_store(user_id))
-    sorted_documents = sorted_documents.to_dict(orient='records')[0:10]
-    sorted_documents = [Document.model_validate(doc) for doc in sorted_documents]
-    return sorted_documents
+@app.get("/recommendations", response_model=List[Document])
+async def prepare_recommended_documents(user_id: str = Query(...),
+                                        k: int = Query(10, ge=1, le=1000),
+                                        offset: int = Query(0, ge=0),
+                                        fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION),
+                                        categories: Optional[str] = Query(None, description=CATEGORIES_DESCRIPTION),
+                                        since: Optional[datetime.date] = Query(None, description=SINCE_DESCRIPTION),
+                                        until: Optional[datetime.date] = Query(None, description=UNTIL_DESCRIPTION)):
+    """
+    Recommendations for a user, ranked offset to offset + k. Only these documents are materialized.
+    Filtered by categories and publication dates, only the documents passing the filters are scored.
+    """
+    state = serving_state()
+    fields = requested_fields(fields)
+    categories = parse_categories(categories)
+    key = (user_id, k, offset, fields, categories, since, until)
+    content = result_cache.lookup(key, state.version)
+    if content is None:
+        content = await run_in_threadpool(recommended_documents, state, user_id, k, offset, fields, categories,
+                                          since, until)
+        result_cache.store(key, state.version, content)
+    return json_response(content)
+
+
+def recommended_documents(state, user_id, k, offset, fields=None, categories=None, since=None, until=None):
+    """
+    Serialized recommendations for a user
+    """
+    retrieval_config = config['ranking_service'].get('candidate_retrieval', {})
+    corpus = state.corpus
+    with stage_timer('feature_lookup'):
+        user_features = state.features.user_features(user_id)
+    rows = state.recommender.recommend(corpus.document_embeddings, user_features, k, offset,
+                                       candidate_index=corpus.candidate_index,
+                                       n_candidates=retrieval_config.get('n_candidates', 200),
+                                       evaluate=retrieval_config.get('evaluate', False),
+                                       allowed=allowed_documents(corpus, categories, since, until))
+    with stage_timer('serialize'):
+        return dumps(corpus.records.get(rows, fields))
+
+
+@app.post("/recommendations/batch", response_model=List[UserRecommendations])
+async def prepare_batch_recommendations(request: BatchRecommendationRequest):
+    """
+    Top k recommendations for many users, e.g. to warm caches or send digests.
+    Features of all users are fetched at once and the users are scored together against all documents.
+    """
+    fields = requested_fields(request.fields)
+    content = await run_in_threadpool(batch_recommendations, serving_state(), request.user_ids, request.k, fields,
+                                      parse_categories(request.categories), request.since, request.until)
+    return json_response(content)
+
+
+def batch_recommendations(state, user_ids, k, fields=None, categories=None, since=None, until=None):
+    corpus = state.corpus
+    with stage_timer('feature_lookup'):
+        users_features = state.features.user_features_batch(user_ids)
+    users_rows = state.recommender.recommend_batch(corpus.document_embeddings, users_features, k,
+                                                   config['ranking_service'].get('batch_block_size', 256),
+                                                   allowed=allowed_documents(corpus, categories, since, until))
+    with stage_timer('serialize'):
+        unique_rows = np.unique(np.concatenate(users_rows)).tolist() if users_rows else []
+        documents = dict(zip(unique_rows, corpus.records.get(unique_rows, fields)))
+        return dumps([{'user_id': user_id, 'documents': [documents[row] for row in rows.tolist()]}
+                      for user_id, rows in zip(user_ids, users_rows)])
+
+
+@app.get("/documents/{entry_id:path}", response_model=Document)
+async def document(entry_id: str, fields: Optional[str] = Query(None, description=FIELDS_DESCRIPTION)):
+    """
+    One document by its entry id, e.g. the details of a recommendation requested with only a few fields
+    """
+    state = serving_state()
+    fields = requested_fields(fields)
+    row = state.corpus.document_rows.get(entry_id)
+    if row is None:
+        raise HTTPException(status_code=404, detail=f'Unknown document {entry_id}')
+    return json_response(dumps(state.corpus.records.get([row], fields)[0]))
+
+
+@app.post("/admin/reload")
+async def reload():
+    """
+    Reload corpus, user features and scoring model now, instead of waiting for the file watcher
+    """
+    serving_state()
+    state = await run_in_threadpool(reloader.reload)
+    return {'version': state.version, 'documents': len(state.corpus.documents)}
+
+
+@app.middleware("http")
+async def measure_latency(request: Request, call_next):
+    start = time.perf_counter()
+    response = await call_next(request)
+    REQUEST_SECONDS.observe(time.perf_counter() - start, path=route_path(request), method=request.method,
+                            status=response.status_code)
+    return response
+
+
+def route_path(request):
+    """
+    Path template of the route of a request, so paths with parameters are counted together
+    """
+    for route in app.router.routes:
+        match, _ = route.matches(request.scope)
+        if match == Match.FULL:
+            return route.path
+    return 'unmatched'
+
+
+def served_documents():
+    return len(reloader.state.corpus.documents) if reloader.state is not None else 0
+
+
+def serving_info():
+    version = reloader.state.version if reloader.state is not None else ''
+    return [({'version': version, 'phase': startup['phase']}, 1)]
+
+
+REGISTRY.register(Gauge('corpus_documents', 'Number of documents served', function=served_documents))
+REGISTRY.register(Gauge('serving_info', 'Version of the served features and models and startup phase',
+                        labels=('version', 'phase'), function=serving_info))
+cache_counter('cache_lookups_total', 'Lookups of the in-memory caches',
+              {'result': result_cache, 'user_features': feature_cache, 'query_embedding': query_cache,
+               'title_embedding': title_cache})
+profiler = SamplingProfiler()
+
+
+@app.get("/metrics")
+async def metrics():
+    """
+    Metrics in the Prometheus text format
+    """
+    return PlainTextResponse(REGISTRY.render(), media_type='text/plain; version=0.0.4')
+
+
+@app.post("/admin/profiler/start")
+async def start_profiler(interval_ms: float = Query(10, gt=0)):
+    """
+    Start sampling the stacks of all threads, the samples of a previous run are dropped
+    """
+    profiler.start(interval_ms / 1000)
+    return {'running': True, 'interval_ms': interval_ms}
+
+
+@app.post("/admin/profiler/stop")
+async def stop_profiler():
+    await run_in_threadpool(profiler.stop)
+    return {'running': False, 'samples': profiler.samples}
+
+
+@app.get("/admin/profiler")
+async def profiler_report(limit: Optional[int] = Query(None, ge=1)):
+    """
+    Sampled stacks in the folded format of flame graph tools, most frequent first
+    """
+    return PlainTextResponse(profiler.report(limit))
+
+
+@app.get("/healthz")
+async def healthz():
+    """
+    Liveness: the server is up. Fails only if starting up failed, so the container gets restarted.
+    """
+    if startup['phase'] == 'failed':
+        return JSONResponse(status_code=500, content=startup)
+    return {'status': 'alive'}
+
+
+@app.get("/readyz")
+async def readyz():
+    """
+    Readiness: everything is loaded and requests can be served
+    """
+    if startup['phase'] != 'ready':
+        return JSONResponse(status_code=503, content=startup)
+    return {'status': 'ready', 'version': reloader.state.version}
 
 
 # Run the app
@@ -0,0 +1,111 @@
+"""
+The documents served for recommendations, with their precomputed embeddings and candidate index.
+"""
+
+import os
+import sys
+
+import pandas as pd
+import pyarrow.parquet as pq
+
+sys.path.append('..')
+import utils
+from feature_store import feature_definitions as fd
+from scoring_model.model_utils import embedding_matrix
+from scoring_model.candidate_index import load_candidate_index
+from scoring_model.quantization import convert_embeddings, load_embeddings
+from documents import DocumentRecords
+from metadata_index import MetadataIndex
+
+
+class Corpus:
+    """
+    Documents and their embeddings, loaded once and never modified, so a new corpus can be loaded
+    next to the one in use and swapped in.
+
+    Embeddings are kept apart from the document metadata as one read-only matrix, row i belonging
+    to document i, so requests can score against it without copying or converting anything.
+    The matrix is float32, or quantized to float16/int8 to save memory.
+    Documents are validated and converted for responses once per corpus, see DocumentRecords.
+    A corpus shared by several worker processes has its documents in an Arrow table, see shared_corpus.
+    The metadata index restricts recommendations to categories and publication dates.
+    """
+
+    def __init__(self, documents, document_embeddings, candidate_index=None, version=None, document_rows=None,
+                 records=None):
+        self.documents = documents
+        self.document_embeddings = document_embeddings
+        if document_rows is None:
+            document_rows = {entry_id: row for row, entry_id in enumerate(documents['entry_id'])}
+        self.document_rows = document_rows
+        self.records = records if records is not None else DocumentRecords(documents)
+        self.metadata_index = MetadataIndex.build(documents)
+        self.candidate_index = candidate_index
+        self.version = version
+
+    @classmethod
+    def load(cls, config):
+        """
+        Load all documents from disc, including precomputed embeddings.
+        This might be handled by the feature store in combination with a preprocessing service, to preselect
+        candidates for recommendations in a more advanced setup.
+        """
+        documents_path = fd.local_file_paths['documents']
+        version = corpus_version()
+        embeddings = load_embedding_sidecar(config, documents_path)
+        if embeddings is None:
+            documents = pd.read_parquet(documents_path)
+            embeddings = convert_embeddings(embedding_matrix(documents['title_embeddings']),
+                                            config.get('embedding_dtype'))
+        else:
+            columns = [c for c in pq.read_schema(documents_path).names if c != 'title_embeddings']
+            documents = pd.read_parquet(documents_path, columns=columns)
+        documents = documents.drop(columns=['title_embeddings'], errors='ignore').reset_index(drop=True)
+        candidate_index = load_corpus_candidate_index(config, embeddings, documents_path)
+        print(f'Loaded {len(documents)} documents')
+        return cls(documents, embeddings, candidate_index, version)
+
+    def document_embedding(self, entry_id):
+        """
+        Stored title embedding of a document, None for unknown documents
+        """
+        row = self.document_rows.get(entry_id)
+        return None if row is None else self.document_embeddings[row]
+
+
+def corpus_version():
+    """
+    Version of the corpus to load, it includes the user features as cached results depend on them
+    """
+    return utils.file_version(fd.local_file_paths['documents'], fd.local_file_paths['user'])
+
+
+def load_embedding_sidecar(config, documents_path):
+    """
+    Memory-map the embedding matrix written next to the document features by the preprocessing,
+    if it is enabled and belongs to the current document file.
+    """
+    path = fd.local_file_paths['document_embeddings']
+    if not config.get('mmap_embeddings', True) or not os.path.exists(path):
+        return None
+    if os.path.getmtime(path) < os.path.getmtime(documents_path):
+        print(f'Embedding file {path} is older than {documents_path}, ignoring it')
+        return None
+    embeddings = load_embeddings(path, mmap=True, dtype=config.get('embedding_dtype'))
+    if len(embeddings) != pq.ParquetFile(documents_path).metadata.num_rows:
+        print(f'Embedding file {path} does not match {documents_path}, ignoring it')
+        return None
+    return embeddings
+
+
+def load_corpus_candidate_index(config, embeddings, documents_path):
+    """
+    Candidate retrieval stage in front of the scoring model, None to score all documents
+    """
+    path = fd.local_file_paths['document_index']
+    retrieval_config = config.get('candidate_retrieval', {})
+    if retrieval_config.get('index') == 'ivf' and os.path.exists(path) \
+            and os.path.getmtime(path) < os.path.getmtime(documents_path):
+        print(f'Candidate index {path} is older than {documents_path}, ignoring it')
+        return None
+    return load_candidate_index(retrieval_config, embeddings, path)
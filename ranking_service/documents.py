@@ -0,0 +1,126 @@
+"""
+Documents as returned by the ranking service, and their serialization.
+"""
+
+import json
+from typing import List, Optional
+
+import numpy as np
+import pyarrow as pa
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+class Document(BaseModel):
+    entry_id: str
+    updated: Optional[str] = None
+    published: Optional[str] = None
+    title: str
+    authors: Optional[List[str]] = None
+    categories: Optional[List[str]] = None
+    comment: Optional[str] = None
+    summary: Optional[str] = None
+    primary_category: Optional[str] = None
+    doi: Optional[str] = None
+    submitted: Optional[str] = None
+    journal_ref: Optional[str] = None
+
+
+FIELDS = tuple(Document.model_fields)
+# of validated documents, see PublishedRecords
+ARROW_SCHEMA = pa.schema([(name, pa.list_(pa.string()) if name in ('authors', 'categories') else pa.string())
+                          for name in FIELDS])
+
+
+def parse_fields(fields):
+    """
+    Fields of a comma separated list, e.g. 'entry_id,title', None for all fields.
+    Raises a ValueError for unknown fields.
+    """
+    if not fields:
+        return None
+    fields = tuple(dict.fromkeys(field.strip() for field in fields.split(',') if field.strip()))
+    unknown = [field for field in fields if field not in FIELDS]
+    if unknown:
+        raise ValueError(f'Unknown fields {unknown}, documents have the fields {list(FIELDS)}')
+    return fields or None
+
+
+def dumps(content):
+    """
+    JSON of plain python objects, with orjson if it is installed
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+class DocumentRecords:
+    """
+    Documents of a corpus validated by the Document model, as plain dicts ready to be serialized.
+    Each document is converted once, when it is first returned, and kept with its corpus.
+    """
+
+    def __init__(self, documents):
+        self.documents = documents
+        self.records = {}
+
+    def get(self, rows, fields=None):
+        """
+        Records of the documents in the given rows, with only the given fields
+        """
+        rows = [int(row) for row in rows]
+        missing = [row for row in dict.fromkeys(rows) if row not in self.records]
+        if missing:
+            for row, document in zip(missing, self.documents.iloc[missing].to_dict(orient='records')):
+                self.records[row] = Document.model_validate(document).model_dump(mode='json')
+        if fields is None:
+            return [self.records[row] for row in rows]
+        return [{field: self.records[row][field] for field in fields} for row in rows]
+
+
+class PublishedRecords:
+    """
+    Records of documents in an Arrow table with ARROW_SCHEMA, which were validated when it was written.
+    Nothing is kept per document, so the table can be memory-mapped and shared by processes.
+    """
+
+    def __init__(self, table):
+        self.table = table
+
+    def get(self, rows, fields=None):
+        table = self.table if fields is None else self.table.select(list(fields))
+        return table.take(pa.array(np.asarray(rows, dtype=np.int64))).to_pylist()
+
+
+class SortedIds:
+    """
+    Rows of documents by entry id like a dict, by binary search over the ids in the order given by sort_order.
+    Nothing is kept per document, so ids and order can be memory-mapped and shared by processes.
+    """
+
+    def __init__(self, ids, sort_order):
+        self.ids = ids
+        self.sort_order = sort_order
+
+    def id(self, i):
+        return self.ids[int(self.sort_order[i])].as_py()
+
+    def get(self, entry_id, default=None):
+        low, high = 0, len(self.sort_order)
+        while low < high:
+            middle = (low + high) // 2
+            if self.id(middle) < entry_id:
+                low = middle + 1
+            else:
+                high = middle
+        if low < len(self.sort_order) and self.id(low) == entry_id:
+            return int(self.sort_order[low])
+        return default
+
+    def __len__(self):
+        return len(self.sort_order)
@@ -0,0 +1,123 @@
+"""
+Micro-batching of embedding model calls across concurrent requests.
+
+Requests encode only a few texts each (often a single query), which wastes most of the throughput of
+batched matrix products. The scheduler collects the texts of concurrent encode calls for up to max_wait_ms
+or until max_batch_size texts are pending, encodes them in one call and hands each caller its rows.
+"""
+
+import asyncio
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+
+class EncodingScheduler:
+    """
+    Drop-in for the embedding model's encode, batching calls from concurrent requests.
+    encode can be called from worker threads (as the sync parts of the request handlers run in the threadpool),
+    encode_async from the event loop.
+    """
+
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.loop = None
+        self.queue = None
+        self.worker = None
+        # one batch at a time, the model itself runs multithreaded
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='encode')
+
+    def start(self):
+        """
+        Start batching on the running event loop
+        """
+        self.loop = asyncio.get_running_loop()
+        self.queue = asyncio.Queue()
+        self.worker = self.loop.create_task(self.run())
+
+    async def stop(self):
+        """
+        Stop batching. Pending calls fail with a RuntimeError instead of waiting forever for their embeddings.
+        """
+        if self.worker is not None:
+            self.worker.cancel()
+            try:
+                await self.worker
+            except asyncio.CancelledError:
+                pass
+            self.worker = None
+        pending = []
+        while self.queue is not None and not self.queue.empty():
+            pending.append(self.queue.get_nowait())
+        fail(pending, RuntimeError('Encoding stopped'))
+        self.loop = None
+
+    async def encode_async(self, texts):
+        if not texts:
+            return self.model.encode(texts)
+        if self.worker is None:
+            raise RuntimeError('Encoding stopped')
+        future = self.loop.create_future()
+        await self.queue.put((list(texts), future))
+        return await future
+
+    def encode(self, texts, **kwargs):
+        """
+        Blocking encode for worker threads. Falls back to the model when the scheduler does not run,
+        or if called with model specific arguments.
+        """
+        if self.loop is None or kwargs or self.on_loop_thread():
+            return self.model.encode(texts, **kwargs)
+        return asyncio.run_coroutine_threadsafe(self.encode_async(texts), self.loop).result()
+
+    def on_loop_thread(self):
+        try:
+            return asyncio.get_running_loop() is self.loop
+        except RuntimeError:
+            return False
+
+    async def run(self):
+        while True:
+            batch = [await self.queue.get()]
+            try:
+                size = len(batch[0][0])
+                deadline = time.monotonic() + self.max_wait
+                while size < self.max_batch_size:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        request = await asyncio.wait_for(self.queue.get(), timeout)
+                    except asyncio.TimeoutError:
+                        break
+                    batch.append(request)
+                    size += len(request[0])
+                await self.encode_batch(batch)
+            except asyncio.CancelledError:
+                fail(batch, RuntimeError('Encoding stopped'))
+                raise
+
+    async def encode_batch(self, batch):
+        texts = [text for request_texts, _ in batch for text in request_texts]
+        try:
+            embeddings = await self.loop.run_in_executor(self.executor, self.model.encode, texts)
+        except Exception as e:
+            fail(batch, e)
+            return
+        start = 0
+        for request_texts, future in batch:
+            if not future.done():
+                future.set_result(np.asarray(embeddings[start:start + len(request_texts)]))
+            start += len(request_texts)
+
+
+def fail(requests, error):
+    """
+    Set the error on the futures of requests which have no result yet
+    """
+    for _, future in requests:
+        if not future.done():
+            future.set_exception(error)
@@ -0,0 +1,120 @@
+"""
+Online user features for the ranking service.
+
+Features come from a backend, either the feast online store (FeatureHandler) or the user feature file
+served directly. Both return the features of many users in one lookup. Looked up features are cached
+in-process for one version of the served features, so frequent users skip the backend entirely.
+"""
+
+import datetime
+import os
+import sys
+
+import numpy as np
+import pyarrow.parquet as pq
+
+sys.path.append('..')
+from feature_store import feature_definitions as fd
+from scoring_model.quantization import load_embeddings
+
+MISSING = {'query': '', 'title': '', 'query_embedding': None, 'title_embedding': None}
+
+
+def user_embeddings_path(key):
+    """
+    Embedding matrix written next to the user feature file for the direct backend, key is query or title
+    """
+    return fd.local_file_paths[f'user_{key}_embeddings']
+
+
+class ParquetFeatures:
+    """
+    User features of the latest user feature file, without the feature store. The embeddings are memory-mapped
+    from the .npy files written next to it, only user ids, timestamps and texts are read from the file (into
+    memory, decoded from parquet), and rows are looked up by user id. Feature names, the entity key and the ttl
+    are those of the feast feature view, so this serves the same features as the online store.
+    """
+
+    def __init__(self, user_ids, texts, embeddings, timestamps, ttl=None):
+        self.rows = {user_id: row for row, user_id in enumerate(user_ids)}
+        self.texts = texts
+        self.embeddings = embeddings
+        self.timestamps = timestamps
+        self.ttl = ttl
+
+    @classmethod
+    def load(cls, ttl=fd.user_stats_fv.ttl):
+        path = fd.local_file_paths['user']
+        join_key = fd.user.join_key
+        timestamp_field = fd.user_stats_source.timestamp_field
+        embeddings = {}
+        for key in ['query', 'title']:
+            sidecar = user_embeddings_path(key)
+            if os.path.exists(sidecar) and os.path.getmtime(sidecar) >= os.path.getmtime(path):
+                embeddings[key] = load_embeddings(sidecar, mmap=True)
+            else:
+                print(f'No current embedding file {sidecar}, reading the embeddings from {path}')
+        # the embedding lists are only decoded for missing embedding files
+        columns = [join_key, timestamp_field, 'query', 'title'] + \
+            [f'user_{key}_embeddings' for key in ['query', 'title'] if key not in embeddings]
+        table = pq.read_table(path, columns=columns)
+        texts = {key: table.column(key).combine_chunks() for key in ['query', 'title']}
+        for key in ['query', 'title']:
+            if key not in embeddings:
+                column = table.column(f'user_{key}_embeddings').combine_chunks()
+                embeddings[key] = column.flatten().to_numpy().astype(np.float32).reshape(len(column), -1)
+            if len(embeddings[key]) != table.num_rows:
+                raise ValueError(f'{user_embeddings_path(key)} has {len(embeddings[key])} rows, '
+                                 f'{path} has {table.num_rows}')
+        timestamps = table.column(timestamp_field).to_numpy().astype('datetime64[us]')
+        print(f'Loaded features of {table.num_rows} users')
+        return cls(table.column(join_key).to_pylist(), texts, embeddings, timestamps, ttl)
+
+    def user_features_from_store_batch(self, user_ids):
+        """
+        Features of many users, those of unknown users or expired by the ttl are missing
+        """
+        oldest = None if not self.ttl else np.datetime64(datetime.datetime.now() - self.ttl, 'us')
+        features = []
+        for user_id in user_ids:
+            row = self.rows.get(user_id)
+            if row is None or (oldest is not None and self.timestamps[row] < oldest):
+                features.append(MISSING)
+                continue
+            features.append({
+                'query': self.texts['query'][row].as_py() or '',
+                'title': self.texts['title'][row].as_py() or '',
+                'query_embedding': self.embeddings['query'][row],
+                'title_embedding': self.embeddings['title'][row],
+            })
+        return features
+
+
+class FeatureServer:
+    """
+    Batched lookups of user features from a backend, through a cache for one version of the features
+    """
+
+    def __init__(self, backend, cache, version):
+        self.backend = backend
+        self.cache = cache
+        self.version = version
+
+    def user_features(self, user_id):
+        return self.user_features_batch([user_id])[0]
+
+    def user_features_batch(self, user_ids):
+        """
+        Features of many users, only those which are not cached are looked up in the backend, in one call
+        """
+        features = {}
+        for user_id in dict.fromkeys(user_ids):
+            cached = self.cache.lookup(user_id, self.version)
+            if cached is not None:
+                features[user_id] = cached
+        missing = [user_id for user_id in dict.fromkeys(user_ids) if user_id not in features]
+        if missing:
+            for user_id, user_features in zip(missing, self.backend.user_features_from_store_batch(missing)):
+                self.cache.store(user_id, self.version, user_features)
+                features[user_id] = user_features
+        return [features[user_id] for user_id in user_ids]
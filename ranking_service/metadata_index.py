@@ -0,0 +1,87 @@
+"""
+Inverted index of document metadata, to restrict recommendations to categories and publication dates.
+
+Filters are applied before documents are scored: they give a mask of the allowed rows of the corpus, and only
+allowed documents are retrieved as candidates and scored. A filtered request is cheaper than an unfiltered one.
+"""
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+
+def metadata_columns(documents):
+    """
+    Categories (lists), primary categories and publication dates of documents in a DataFrame or an Arrow table
+    """
+    if isinstance(documents, pa.Table):
+        return tuple(documents.column(name).to_pandas() for name in ['categories', 'primary_category', 'published'])
+    return documents['categories'], documents['primary_category'], documents['published']
+
+
+class MetadataIndex:
+    """
+    - categories: for each category (primary or cross-listed), a bitmap of the rows of its documents, packed
+      8 rows per byte
+    - publication dates: rows sorted by the day they were published, with the sorted days, so the documents
+      of a date range are a slice. Documents without a date are not in it.
+    """
+
+    def __init__(self, n_rows, category_bitmaps, published_rows, published_days):
+        self.n_rows = n_rows
+        self.category_bitmaps = category_bitmaps
+        self.published_rows = published_rows
+        self.published_days = published_days
+
+    @classmethod
+    def build(cls, documents):
+        categories, primary_categories, published = metadata_columns(documents)
+        n_rows = len(categories)
+        exploded = categories.reset_index(drop=True).explode()
+        entries = pd.DataFrame({
+            'row': np.concatenate([exploded.index.to_numpy(), np.arange(n_rows)]),
+            'category': np.concatenate([exploded.to_numpy(dtype=object),
+                                        primary_categories.to_numpy(dtype=object)]),
+        }).dropna().drop_duplicates()
+        category_bitmaps = {}
+        for category, rows in entries.groupby('category')['row']:
+            mask = np.zeros(n_rows, dtype=bool)
+            mask[rows.to_numpy()] = True
+            category_bitmaps[category] = np.packbits(mask)
+        days = pd.to_datetime(published.reset_index(drop=True), errors='coerce').to_numpy(dtype='datetime64[D]')
+        published_rows = np.flatnonzero(~np.isnat(days))
+        published_rows = published_rows[np.argsort(days[published_rows], kind='stable')]
+        return cls(n_rows, category_bitmaps, published_rows, days[published_rows])
+
+    def category_mask(self, categories):
+        """
+        Rows of documents in any of the categories
+        """
+        bits = np.zeros((self.n_rows + 7) // 8, dtype=np.uint8)
+        for category in categories:
+            if category in self.category_bitmaps:
+                bits |= self.category_bitmaps[category]
+        return np.unpackbits(bits, count=self.n_rows).astype(bool)
+
+    def published_mask(self, since=None, until=None):
+        """
+        Rows of documents published from since to until (dates, both included)
+        """
+        days = self.published_days
+        start = 0 if since is None else np.searchsorted(days, np.datetime64(since, 'D'), side='left')
+        end = len(days) if until is None else np.searchsorted(days, np.datetime64(until, 'D'), side='right')
+        mask = np.zeros(self.n_rows, dtype=bool)
+        mask[self.published_rows[start:end]] = True
+        return mask
+
+    def mask(self, categories=None, since=None, until=None):
+        """
+        Boolean mask of the rows of documents in any of the categories and published from since to until,
+        None without filters
+        """
+        if not categories and since is None and until is None:
+            return None
+        mask = self.category_mask(categories) if categories else np.ones(self.n_rows, dtype=bool)
+        if since is not None or until is not None:
+            mask &= self.published_mask(since, until)
+        return mask
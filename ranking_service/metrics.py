@@ -0,0 +1,215 @@
+"""
+Metrics of the ranking service in the Prometheus text format, and a sampling profiler.
+
+Metrics are counters, gauges and histograms with optional labels. Values which are already tracked
+elsewhere (e.g. cache hits, the corpus size) are read by a function when the metrics are rendered, so
+nothing is added to the request path for them.
+"""
+
+import os
+import sys
+import threading
+import time
+from collections import Counter as StackCounter
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return '{' + ','.join(f'{key}="{escape(value)}"' for key, value in labels.items()) + '}'
+
+
+class Metric:
+    """
+    A metric with a value per combination of label values. With a function, the values are whatever it returns
+    when rendered: a number, or a list of (labels, number) pairs.
+    """
+    type = None
+
+    def __init__(self, name, help, labels=(), function=None):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self.function = function
+        self.values = {}
+        self.lock = threading.Lock()
+
+    def key(self, labels):
+        return tuple(str(labels[label]) for label in self.labels)
+
+    def samples(self):
+        if self.function is None:
+            with self.lock:
+                return [(dict(zip(self.labels, key)), value) for key, value in self.values.items()]
+        values = self.function()
+        return values if isinstance(values, list) else [({}, values)]
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        lines.extend(f'{self.name}{format_labels(labels)} {value}' for labels, value in self.samples())
+        return lines
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, value=1, **labels):
+        key = self.key(labels)
+        with self.lock:
+            self.values[key] = self.values.get(key, 0) + value
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        with self.lock:
+            self.values[self.key(labels)] = value
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, help, labels=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help, labels)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self.key(labels)
+        with self.lock:
+            if key not in self.values:
+                self.values[key] = [[0] * len(self.buckets), 0.0, 0]
+            counts, _, _ = self.values[key]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self.values[key][1] += value
+            self.values[key][2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.help}', f'# TYPE {self.name} {self.type}']
+        with self.lock:
+            values = [(key, list(counts), total, count) for key, (counts, total, count) in self.values.items()]
+        for key, counts, total, count in values:
+            labels = dict(zip(self.labels, key))
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                lines.append(f'{self.name}_bucket{format_labels({**labels, "le": bound})} {cumulative}')
+            lines.append(f'{self.name}_bucket{format_labels({**labels, "le": "+Inf"})} {count}')
+            lines.append(f'{self.name}_sum{format_labels(labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(labels)} {count}')
+        return lines
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            try:
+                lines.extend(metric.render())
+            except Exception as e:
+                # e.g. a function reading state which is not loaded yet
+                lines.append(f'# {metric.name} unavailable: {e!r}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+REQUEST_SECONDS = REGISTRY.register(Histogram('http_request_duration_seconds', 'Latency of requests',
+                                              labels=('path', 'method', 'status')))
+STAGE_SECONDS = REGISTRY.register(Histogram('ranking_stage_duration_seconds', 'Latency of the stages of requests',
+                                            labels=('stage',)))
+
+
+def stage_timer(stage):
+    """
+    Context manager timing a stage of a request, the timer hook of the recommendation model
+    """
+    return STAGE_SECONDS.time(stage=stage)
+
+
+def cache_counter(name, help, caches):
+    """
+    Counter of the hits and misses of caches (LRUCache), by name
+    """
+    def samples():
+        return [({'cache': cache_name, 'result': result}, count) for cache_name, cache in caches.items()
+                for result, count in [('hit', cache.hits), ('miss', cache.misses)]]
+    return REGISTRY.register(Counter(name, help, labels=('cache', 'result'), function=samples))
+
+
+class SamplingProfiler:
+    """
+    Samples the stacks of all threads at an interval while it is running, to see where time is spent in
+    production. Stacks are counted in the folded format of flame graph tools, "outer;...;inner count".
+    """
+
+    def __init__(self):
+        self.thread = None
+        self.stopped = threading.Event()
+        self.stacks = StackCounter()
+        self.samples = 0
+        self.interval_s = None
+        self.lock = threading.Lock()
+
+    @property
+    def running(self):
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self, interval_s=0.01):
+        with self.lock:
+            if self.running:
+                return
+            self.stacks, self.samples, self.interval_s = StackCounter(), 0, interval_s
+            self.stopped.clear()
+            self.thread = threading.Thread(target=self.run, name='profiler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        with self.lock:
+            self.stopped.set()
+            if self.thread is not None:
+                self.thread.join()
+
+    def run(self):
+        own_id = threading.get_ident()
+        while not self.stopped.wait(self.interval_s):
+            for thread_id, frame in sys._current_frames().items():
+                if thread_id == own_id:
+                    continue
+                functions = []
+                while frame is not None:
+                    functions.append(f'{os.path.basename(frame.f_code.co_filename)}:{frame.f_code.co_name}')
+                    frame = frame.f_back
+                self.stacks[';'.join(reversed(functions))] += 1
+            self.samples += 1
+
+    def report(self, limit=None):
+        """
+        Folded stacks, most frequent first
+        """
+        stacks = self.stacks.copy().most_common(limit)
+        return '\n'.join(f'{stack} {count}' for stack, count in stacks) + '\n'
@@ -0,0 +1,78 @@
+"""
+Reload the served corpus and models when the preprocessing or the training writes new files.
+"""
+
+import threading
+import traceback
+import sys
+
+sys.path.append('..')
+import utils
+
+
+class ServingState:
+    """
+    Everything a request needs that is replaced together on a reload: the corpus, the recommender
+    with its scoring model and the user features. Requests take the current state once, so they finish on the
+    version they started with.
+    """
+
+    def __init__(self, corpus, recommender, version, features=None):
+        self.corpus = corpus
+        self.recommender = recommender
+        self.version = version
+        self.features = features
+
+
+class Reloader:
+    """
+    Builds a new serving state in the background when watched files change, and swaps it in atomically.
+    Files have to be unchanged for one more poll before reloading, so files being written are not picked up.
+    """
+
+    def __init__(self, load, watched_paths, interval_s=60):
+        self.load = load
+        self.watched_paths = watched_paths
+        self.interval_s = interval_s
+        self.state = None
+        self.fingerprint = None
+        self.pending_fingerprint = None
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def reload(self):
+        """
+        Load a new state and swap it in. The previous state stays in use if loading fails.
+        """
+        with self.lock:
+            fingerprint = utils.file_version(*self.watched_paths)
+            print('Loading serving state')
+            self.state = self.load()
+            self.fingerprint = fingerprint
+            print(f'Serving version {self.state.version}')
+            return self.state
+
+    def check(self):
+        fingerprint = utils.file_version(*self.watched_paths)
+        if fingerprint == self.fingerprint:
+            self.pending_fingerprint = None
+        elif fingerprint != self.pending_fingerprint:
+            self.pending_fingerprint = fingerprint
+        else:
+            self.reload()
+
+    def start(self):
+        if self.interval_s:
+            self.thread = threading.Thread(target=self.watch, name='reloader', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        self.stopped.set()
+
+    def watch(self):
+        while not self.stopped.wait(self.interval_s):
+            try:
+                self.check()
+            except Exception:
+                traceback.print_exc()
@@ -0,0 +1,32 @@
+"""
+Cache of serialized recommendation results.
+"""
+
+import sys
+
+sys.path.append('..')
+from scoring_model.embedding_cache import LRUCache
+
+
+class ResultCache(LRUCache):
+    """
+    LRU cache with expiring entries for the serialized results of a request (or the features of a user), valid
+    for one version of the served features and models. Looking up a new version flushes the cache.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        super().__init__(maxsize, ttl)
+        self.version = None
+
+    def lookup(self, key, version):
+        with self.lock:
+            if version != self.version:
+                self.entries.clear()
+                self.version = version
+                self.misses += 1
+                return None
+        return self.get(key)
+
+    def store(self, key, version, result):
+        if version == self.version:
+            self.put(key, result)
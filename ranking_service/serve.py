@@ -0,0 +1,55 @@
+"""
+Serve the ranking service with several worker processes, to use all cores of a node.
+
+Workers are forked by gunicorn from a master process which has loaded the embedding model (preload), so its
+weights are in memory once and shared copy-on-write. Each worker loads the scoring model itself, attaches to
+the corpus published once for all of them (see shared_corpus) and reads the feast features materialized once
+for all of them (see FeatureHandler in app).
+Run `python serve.py`, or `python app.py` for a single process without gunicorn.
+"""
+
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+sys.path.append('..')
+import utils
+
+
+class RankingServer(BaseApplication):
+
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        """
+        Called once in the master process before the workers are forked
+        """
+        import app
+        app.preload(self.options['workers'])
+        return app.app
+
+
+def main():
+    config = utils.load_config()['ranking_service']
+    workers = config.get('workers') or os.cpu_count() or 1
+    options = {
+        'bind': '0.0.0.0:8000',
+        'workers': workers,
+        'worker_class': 'uvicorn.workers.UvicornWorker',
+        'preload_app': True,
+        # models and features are loaded in the background after the fork, the workers answer health checks meanwhile
+        'timeout': 120,
+    }
+    print(f'Starting {workers} workers')
+    RankingServer(options).run()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,124 @@
+"""
+The corpus shared by the worker processes of the ranking service (see serve.py).
+
+Loading the corpus in every worker would keep a copy of the documents and embeddings per process. Instead,
+the first worker to load a version of the corpus publishes it into a folder:
+- the embedding matrix as .npy (with int8 scales), as loaded and converted to the configured dtype,
+- the documents, validated for responses, as an Arrow IPC file, with the sort order of their entry ids,
+- the lists of the IVF candidate index as .npy.
+All workers attach to these files memory-mapped and read-only, so their pages are in memory only once per node.
+A file lock per version makes one worker publish it while the others wait, old versions are removed
+by the worker publishing a new one.
+"""
+
+import fcntl
+import glob
+import os
+import shutil
+import sys
+
+import numpy as np
+import pyarrow as pa
+
+sys.path.append('..')
+import utils
+from feature_store import feature_definitions as fd
+from scoring_model.candidate_index import ExactIndex, IVFIndex
+from scoring_model.quantization import QuantizedEmbeddings, load_embeddings, scales_path
+from corpus import Corpus, corpus_version
+from documents import ARROW_SCHEMA, DocumentRecords, PublishedRecords, SortedIds
+
+IVF_ARRAYS = ['centroids', 'list_offsets', 'list_rows']
+
+
+def published_version(config):
+    """
+    Version of the published files, which only depend on the document files and the configured embedding dtype
+    """
+    files = utils.file_version(fd.local_file_paths['documents'], fd.local_file_paths['document_embeddings'],
+                               fd.local_file_paths['document_index'])
+    index = config.get('candidate_retrieval', {}).get('index', 'none')
+    return f'{files}-{config.get("embedding_dtype") or "stored"}-{index}'
+
+
+def load_shared_corpus(config, folder, batch_size=10000):
+    """
+    Corpus attached to the published files of the current version, which are published first if needed
+    """
+    version = published_version(config)
+    path = os.path.join(folder, version)
+    os.makedirs(folder, exist_ok=True)
+    with open(f'{path}.lock', 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        if not os.path.exists(path):
+            publish(Corpus.load(config), path, batch_size)
+            remove_old_versions(folder, version)
+    return attach(path, config, corpus_version())
+
+
+def publish(corpus, path, batch_size=10000):
+    """
+    Write the files of a corpus to a new folder, which is renamed to path once complete
+    """
+    tmp_path = f'{path}.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    embeddings = corpus.document_embeddings
+    if isinstance(embeddings, QuantizedEmbeddings):
+        np.save(os.path.join(tmp_path, 'embeddings.npy'), embeddings.codes)
+        if embeddings.scales is not None:
+            np.save(scales_path(os.path.join(tmp_path, 'embeddings.npy')), embeddings.scales)
+    else:
+        np.save(os.path.join(tmp_path, 'embeddings.npy'), np.asarray(embeddings))
+    with pa.OSFile(os.path.join(tmp_path, 'documents.arrow'), 'wb') as sink:
+        with pa.ipc.new_file(sink, ARROW_SCHEMA) as writer:
+            for start in range(0, len(corpus.documents), batch_size):
+                rows = range(start, min(start + batch_size, len(corpus.documents)))
+                # converted one batch at a time, so not all records are in memory at once
+                records = DocumentRecords(corpus.documents).get(rows)
+                writer.write_table(pa.Table.from_pylist(records, schema=ARROW_SCHEMA))
+    entry_ids = corpus.documents['entry_id'].to_numpy(dtype=object)
+    np.save(os.path.join(tmp_path, 'entry_order.npy'), np.argsort(entry_ids, kind='stable'))
+    if isinstance(corpus.candidate_index, IVFIndex):
+        for name in IVF_ARRAYS:
+            np.save(os.path.join(tmp_path, f'{name}.npy'), getattr(corpus.candidate_index, name))
+    os.rename(tmp_path, path)
+    print(f'Published {len(corpus.documents)} documents to {path}')
+
+
+def attach(path, config, version):
+    """
+    Corpus of published files, memory-mapped
+    """
+    embeddings = load_embeddings(os.path.join(path, 'embeddings.npy'), mmap=True)
+    documents = pa.ipc.open_file(pa.memory_map(os.path.join(path, 'documents.arrow'))).read_all()
+    entry_order = np.load(os.path.join(path, 'entry_order.npy'), mmap_mode='r')
+    retrieval_config = config.get('candidate_retrieval', {})
+    candidate_index = None
+    if os.path.exists(os.path.join(path, 'list_rows.npy')):
+        arrays = [np.load(os.path.join(path, f'{name}.npy'), mmap_mode='r') for name in IVF_ARRAYS]
+        candidate_index = IVFIndex(embeddings, *arrays, n_probe=retrieval_config.get('n_probe', 8))
+    elif retrieval_config.get('index') == 'exact':
+        candidate_index = ExactIndex(embeddings)
+    print(f'Attached {len(documents)} documents from {path}')
+    return Corpus(documents, embeddings, candidate_index, version,
+                  document_rows=SortedIds(documents.column('entry_id'), entry_order),
+                  records=PublishedRecords(documents))
+
+
+def remove_old_versions(folder, version):
+    """
+    Remove published versions other than the given one, unless a worker is publishing them.
+    Workers still attached to a removed version keep their mapped files until they reload.
+    """
+    for lock_path in glob.glob(os.path.join(folder, '*.lock')):
+        old_version = os.path.basename(lock_path)[:-len('.lock')]
+        if old_version == version:
+            continue
+        with open(lock_path, 'w') as lock:
+            try:
+                fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                continue
+            shutil.rmtree(os.path.join(folder, old_version), ignore_errors=True)
+            os.remove(lock_path)
@@ -0,0 +1,175 @@
+"""
+Candidate retrieval for the document corpus.
+
+Instead of scoring every document, the ranking service can first retrieve candidates whose title embeddings
+are most similar to the user embeddings, and only score those.
+- ExactIndex scans all documents and is the reference for the recall of approximate indices.
+- IVFIndex is an inverted file index: documents are clustered with k-means, and a search only scans
+  the documents of the clusters closest to the query.
+
+The IVF index is built during preprocessing and stored next to the document features.
+Run this script to evaluate the recall of the stored index against an exact search.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append('..')
+from scoring_model.model_utils import top_k
+from scoring_model.quantization import load_embeddings
+
+
+class ExactIndex:
+    """
+    Exact maximum inner product search over all documents
+    """
+
+    def __init__(self, embeddings):
+        self.embeddings = embeddings
+
+    def search(self, query, n_candidates, allowed=None):
+        if allowed is None:
+            return top_k(self.embeddings @ query, n_candidates)
+        rows = np.flatnonzero(allowed)
+        return rows[top_k(self.embeddings[rows] @ query, n_candidates)]
+
+    def candidates(self, queries, n_candidates, allowed=None):
+        """
+        Union of the best n_candidates rows for each query vector, only of the allowed rows (a boolean mask) if given
+        """
+        return np.unique(np.concatenate([self.search(query, n_candidates, allowed) for query in queries]))
+
+
+class IVFIndex(ExactIndex):
+    """
+    Inverted file index for approximate maximum inner product search.
+    Rows of the embedding matrix are grouped by their closest centroid, the lists are stored
+    back to back in list_rows with list_offsets marking their boundaries.
+    """
+
+    def __init__(self, embeddings, centroids, list_offsets, list_rows, n_probe=8):
+        super().__init__(embeddings)
+        self.centroids = centroids
+        self.list_offsets = list_offsets
+        self.list_rows = list_rows
+        self.n_probe = n_probe
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=10, seed=42, n_probe=8):
+        """
+        Cluster the embeddings with spherical k-means, by default into about sqrt(n) lists
+        """
+        n_lists = min(n_lists or int(np.sqrt(len(embeddings))) or 1, len(embeddings))
+        rng = np.random.default_rng(seed)
+        centroids = np.array(embeddings[rng.choice(len(embeddings), n_lists, replace=False)], dtype=np.float32)
+        for _ in range(n_iter):
+            assignment = assign(embeddings, centroids)
+            counts = np.bincount(assignment, minlength=n_lists)
+            starts = np.cumsum(counts) - counts
+            sums = np.zeros_like(centroids)
+            sums[counts > 0] = np.add.reduceat(embeddings[np.argsort(assignment, kind='stable')],
+                                               starts[counts > 0], axis=0)
+            sums[counts == 0] = embeddings[rng.choice(len(embeddings), (counts == 0).sum())]
+            centroids = sums / np.maximum(np.linalg.norm(sums, axis=1, keepdims=True), 1e-12)
+        assignment = assign(embeddings, centroids)
+        list_rows = np.argsort(assignment, kind='stable')
+        list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+        return cls(embeddings, centroids.astype(np.float32), list_offsets, list_rows, n_probe)
+
+    def save(self, path):
+        tmp_path = f'{path}.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, list_offsets=self.list_offsets, list_rows=self.list_rows)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, embeddings, n_probe=8):
+        with np.load(path) as data:
+            index = cls(embeddings, data['centroids'], data['list_offsets'], data['list_rows'], n_probe)
+        if len(index.list_rows) != len(embeddings):
+            raise ValueError(f'Index {path} has {len(index.list_rows)} rows, expected {len(embeddings)}')
+        return index
+
+    def candidates(self, queries, n_candidates, allowed=None):
+        list_sizes = self.list_sizes(allowed)
+        return np.unique(np.concatenate([self.search(query, n_candidates, allowed, list_sizes) for query in queries]))
+
+    def list_sizes(self, allowed=None):
+        """
+        Number of rows in each list, only counting the allowed rows (a boolean mask) if given
+        """
+        if allowed is None:
+            return np.diff(self.list_offsets)
+        counts = np.concatenate([[0], np.cumsum(allowed[self.list_rows])])
+        return counts[self.list_offsets[1:]] - counts[self.list_offsets[:-1]]
+
+    def search(self, query, n_candidates, allowed=None, list_sizes=None):
+        """
+        Scan the n_probe lists with the closest centroids, and more if they hold fewer than n_candidates
+        (allowed) rows. Only allowed rows are scored.
+        """
+        if list_sizes is None:
+            list_sizes = self.list_sizes(allowed)
+        order = np.argsort(-(self.centroids @ query))
+        sizes = np.cumsum(list_sizes[order])
+        n_lists = max(self.n_probe, int(np.searchsorted(sizes, n_candidates)) + 1)
+        rows = np.concatenate([self.list_rows[self.list_offsets[c]:self.list_offsets[c + 1]]
+                               for c in order[:n_lists]])
+        if allowed is not None:
+            rows = rows[allowed[rows]]
+        return rows[top_k(self.embeddings[rows] @ query, n_candidates)]
+
+
+def assign(embeddings, centroids, batch_size=8192):
+    """
+    Closest centroid (by inner product) for each embedding, in batches to bound memory
+    """
+    return np.concatenate([np.argmax(embeddings[i:i + batch_size] @ centroids.T, axis=1)
+                           for i in range(0, len(embeddings), batch_size)])
+
+
+def load_candidate_index(config, embeddings, path):
+    """
+    Candidate retrieval configured for the ranking service. None means all documents are scored.
+    """
+    index_type = config.get('index', 'none')
+    if index_type == 'exact':
+        return ExactIndex(embeddings)
+    if index_type == 'ivf':
+        if os.path.exists(path):
+            try:
+                return IVFIndex.load(path, embeddings, config.get('n_probe', 8))
+            except ValueError as e:
+                print(e)
+        print(f'No valid candidate index found at {path}, scoring all documents')
+    return None
+
+
+def recall(index, queries, n_candidates):
+    """
+    Mean fraction of the exact best n_candidates rows per query which the index retrieves
+    """
+    exact = ExactIndex(index.embeddings)
+    hits = [len(np.intersect1d(index.search(q, n_candidates), exact.search(q, n_candidates))) for q in queries]
+    return np.mean(hits) / min(n_candidates, len(index.embeddings))
+
+
+def evaluate(n_queries=200, n_candidates=(10, 50, 200), n_probes=(1, 4, 8, 16)):
+    """
+    Recall of the stored IVF index against exact search, with random documents as queries
+    """
+    from feature_store import feature_definitions as fd
+    embeddings = load_embeddings(fd.local_file_paths['document_embeddings'])
+    index = IVFIndex.load(fd.local_file_paths['document_index'], embeddings)
+    queries = embeddings[np.random.default_rng(0).choice(len(embeddings), n_queries)]
+    print(f'{len(embeddings)} documents in {len(index.centroids)} lists')
+    for n_probe in n_probes:
+        index.n_probe = n_probe
+        results = ', '.join(f'recall@{n}: {recall(index, queries, n):.3f}' for n in n_candidates)
+        print(f'n_probe {n_probe}: {results}')
+
+
+if __name__ == '__main__':
+    evaluate()
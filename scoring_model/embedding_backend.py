@@ -0,0 +1,215 @@
+"""
+CPU inference of the embedding model.
+
+The sentence transformer runs in fp32 with torch's default threads and encodes texts in fixed size batches,
+padded to the longest text of each batch. On CPU-only nodes, for the short texts we encode (titles, queries),
+the backend can
+- quantize the linear layers to int8 dynamically (int8 weights, activations quantized per batch),
+- pin the intra-op threads (per operator, e.g. a matrix product) and inter-op threads (between operators),
+- truncate texts to a maximum sequence length sized for titles,
+- encode texts sorted by length, in batches of similar lengths limited by their number of tokens, so
+  little padding is computed and short texts are encoded in large batches.
+The quantized model is only used if its embeddings of sample texts are close to those of the fp32 model.
+
+Run `python embedding_backend.py` to compare the configured backend against the fp32 model.
+"""
+
+import multiprocessing
+import os
+import sys
+import time
+
+import numpy as np
+import torch
+
+# titles and queries like those encoded in serving and preprocessing
+PARITY_TEXTS = [
+    'Attention Is All You Need',
+    'Language Models are Few-Shot Learners',
+    'Deep Residual Learning for Image Recognition',
+    'A Survey of Large Language Models for Autonomous Agents',
+    'Retrieval-Augmented Generation for Knowledge-Intensive NLP Tasks',
+    'On the Convergence of Adam and Beyond',
+    'Graph neural networks for combinatorial optimization: a survey of methods and open problems',
+    'reinforcement learning',
+    'causal inference with observational data',
+    'llm',
+]
+
+# of encode which are supported by the length-bucketed batching
+ENCODE_ARGUMENTS = {'batch_size', 'show_progress_bar', 'normalize_embeddings'}
+
+
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+    """
+    Number of threads used by torch, the defaults are kept for None
+    """
+    if intra_op_threads:
+        torch.set_num_threads(intra_op_threads)
+    if inter_op_threads:
+        try:
+            torch.set_num_interop_threads(inter_op_threads)
+        except RuntimeError as e:
+            # it can only be set once, before any inter-op parallel work
+            print(f'Inter-op threads not set: {e}')
+
+
+def cosine_similarities(a, b):
+    """
+    Pointwise, between two matrices of embeddings
+    """
+    a = np.asarray(a, dtype=np.float32)
+    b = np.asarray(b, dtype=np.float32)
+    norms = np.linalg.norm(a, axis=1) * np.linalg.norm(b, axis=1)
+    return (a * b).sum(axis=1) / np.maximum(norms, 1e-12)
+
+
+def quantize(model, min_similarity=0.99, texts=PARITY_TEXTS):
+    """
+    Model with its linear layers quantized to int8, if its embeddings of the texts have a cosine similarity of
+    at least min_similarity to those of the fp32 model. The fp32 model is returned otherwise.
+    Without min_similarity the model is quantized unchecked, e.g. when it must not run yet.
+    """
+    if min_similarity is None:
+        print('Quantized embedding model to int8, without a parity check')
+        return torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    reference = model.encode(texts)
+    quantized = torch.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    similarity = float(cosine_similarities(quantized.encode(texts), reference).min())
+    if similarity < min_similarity:
+        print(f'Quantized embedding model is not close enough to fp32 (min cosine similarity {similarity:.4f} < '
+              f'{min_similarity}), using fp32')
+        return model
+    print(f'Quantized embedding model to int8, min cosine similarity to fp32: {similarity:.4f}')
+    return quantized
+
+
+class EmbeddingBackend:
+    """
+    Drop-in for a sentence transformer's encode, which encodes texts in length-bucketed batches:
+    sorted by their number of tokens and batched while the padded batch has at most batch_tokens tokens
+    and batch_size texts. quantized tells whether the model runs in int8.
+    """
+
+    def __init__(self, model, batch_size=128, batch_tokens=8192, quantized=False):
+        self.model = model
+        self.batch_size = batch_size
+        self.batch_tokens = batch_tokens
+        self.quantized = quantized
+
+    @property
+    def max_seq_length(self):
+        return self.model.max_seq_length
+
+    def token_counts(self, texts):
+        tokens = self.model.tokenizer(texts, truncation=True, max_length=self.model.max_seq_length)['input_ids']
+        return np.array([len(ids) for ids in tokens])
+
+    def batches(self, lengths):
+        """
+        Indices of the texts of each batch, shortest texts first
+        """
+        batch = []
+        for i in np.argsort(lengths, kind='stable').tolist():
+            # padded to its last (longest) text
+            if batch and (len(batch) == self.batch_size or (len(batch) + 1) * lengths[i] > self.batch_tokens):
+                yield batch
+                batch = []
+            batch.append(i)
+        if batch:
+            yield batch
+
+    def encode(self, texts, **kwargs):
+        """
+        Embeddings of texts, one row each. Calls for a single text or with other arguments (e.g. for other
+        outputs than a numpy array) are passed to the model.
+        """
+        if isinstance(texts, str) or len(texts) == 0 or set(kwargs) - ENCODE_ARGUMENTS:
+            return self.model.encode(texts, **kwargs)
+        texts = list(texts)
+        kwargs.pop('batch_size', None)
+        embeddings = None
+        for batch in self.batches(self.token_counts(texts)):
+            encoded = self.model.encode([texts[i] for i in batch], batch_size=len(batch), **kwargs)
+            if embeddings is None:
+                embeddings = np.empty((len(texts), encoded.shape[1]), dtype=encoded.dtype)
+            embeddings[batch] = encoded
+        return embeddings
+
+
+def optimize(model, config, check_parity=True):
+    """
+    Sentence transformer set up for CPU inference as configured, see embedding_backend in config.yaml.
+    Without check_parity the model does not run, e.g. before worker processes are forked (see passes_parity_check).
+    """
+    configure_threads(config.get('intra_op_threads'), config.get('inter_op_threads'))
+    if config.get('max_seq_length'):
+        model.max_seq_length = config['max_seq_length']
+    quantized = False
+    if config.get('quantize', False):
+        fp32_model = model
+        model = quantize(model, config.get('parity_min_similarity', 0.99) if check_parity else None)
+        quantized = model is not fp32_model
+    return EmbeddingBackend(model, config.get('batch_size', 128), config.get('batch_tokens', 8192), quantized)
+
+
+def quantization_passes(model_path, config):
+    """
+    Whether the model quantized as configured passes the parity check
+    """
+    from sentence_transformers import SentenceTransformer
+    config = dict(config, quantize=True, intra_op_threads=None, inter_op_threads=None)
+    return optimize(SentenceTransformer(model_path), config).quantized
+
+
+def passes_parity_check(model_path, config):
+    """
+    quantization_passes, checked in a spawned process so the model does not run in this one, e.g. before
+    worker processes are forked
+    """
+    with multiprocessing.get_context('spawn').Pool(1) as pool:
+        return pool.apply(quantization_passes, (model_path, config))
+
+
+def model_name(name, config, quantized=False):
+    """
+    Name of the model for stored and cached embeddings, which differ with quantization and truncation.
+    quantized tells whether the model in use is quantized, it is not if it failed the parity check.
+    """
+    if quantized:
+        name += '-int8'
+    if config.get('max_seq_length'):
+        name += f'-{config["max_seq_length"]}'
+    return name
+
+
+def evaluate(n_texts=2000):
+    """
+    Compare embeddings and encoding time of the configured backend and the fp32 model for the titles of the
+    latest documents (or the sample texts)
+    """
+    import pandas as pd
+    from sentence_transformers import SentenceTransformer
+    sys.path.append('..')
+    import utils
+    from feature_store import feature_definitions as fd
+    config = utils.load_config()
+    model_path = os.path.join(utils.base_folder(), config['ranking_service']['model_path'])
+    texts = PARITY_TEXTS
+    if os.path.exists(fd.local_file_paths['documents']):
+        texts = pd.read_parquet(fd.local_file_paths['documents'], columns=['title'])['title'].tolist()[:n_texts]
+    backend = optimize(SentenceTransformer(model_path), config.get('embedding_backend', {}))
+    fp32 = SentenceTransformer(model_path)
+    results = {}
+    for name, model in [('fp32', fp32), ('backend', backend)]:
+        model.encode(texts[:10])
+        start = time.perf_counter()
+        results[name] = model.encode(texts)
+        print(f'{name}: {len(texts) / (time.perf_counter() - start):.1f} texts/s')
+    similarities = cosine_similarities(results['backend'], results['fp32'])
+    print(f'Cosine similarity to fp32 of {len(texts)} texts: mean {similarities.mean():.4f}, '
+          f'min {similarities.min():.4f}')
+
+
+if __name__ == '__main__':
+    evaluate()
@@ -0,0 +1,112 @@
+"""
+Caches for text embeddings computed at serving time.
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+class LRUCache:
+    """
+    Thread-safe cache keeping the most recently used entries, up to maxsize.
+    With a ttl (in seconds), entries also expire after that time.
+    Hits and misses of lookups are counted.
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                self.misses += 1
+                return default
+            expires, value = self.entries[key]
+            if expires is not None and expires < time.monotonic():
+                del self.entries[key]
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value):
+        expires = time.monotonic() + self.ttl if self.ttl else None
+        with self.lock:
+            self.entries[key] = (expires, value)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.maxsize:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class EmbeddingCache(LRUCache):
+    """
+    LRU cache of text embeddings, keyed by a hash of the model name and the text.
+    With a path, embeddings are also persisted in a sqlite file, which is looked up on a miss in memory,
+    so they survive evictions and restarts.
+    """
+
+    def __init__(self, maxsize, model_name='', path=None):
+        super().__init__(maxsize)
+        self.model_name = model_name
+        self.db = None
+        if path:
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            self.db = sqlite3.connect(path, check_same_thread=False)
+            self.db.execute('CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)')
+            self.db_lock = threading.Lock()
+
+    def key(self, text):
+        return hashlib.sha1(f'{self.model_name}\0{text}'.encode()).hexdigest()
+
+    def lookup(self, text):
+        key = self.key(text)
+        embedding = self.get(key)
+        if embedding is None and self.db is not None:
+            with self.db_lock:
+                row = self.db.execute('SELECT embedding FROM embeddings WHERE key = ?', (key,)).fetchone()
+            if row is not None:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                self.put(key, embedding)
+        return embedding
+
+    def store(self, text, embedding):
+        key = self.key(text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        self.put(key, embedding)
+        if self.db is not None:
+            with self.db_lock, self.db:
+                self.db.execute('INSERT OR REPLACE INTO embeddings VALUES (?, ?)', (key, embedding.tobytes()))
+
+
+def encode_cached(model, texts, cache=None):
+    """
+    Embeddings of the texts, only encoding those which are not in the cache (in one batch)
+    """
+    embeddings = [cache.lookup(text) if cache is not None else None for text in texts]
+    missing = [i for i, embedding in enumerate(embeddings) if embedding is None]
+    if missing:
+        encoded = model.encode([texts[i] for i in missing])
+        for i, embedding in zip(missing, encoded):
+            embeddings[i] = embedding
+            if cache is not None:
+                cache.store(texts[i], embedding)
+    return embeddings
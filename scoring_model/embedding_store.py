@@ -0,0 +1,88 @@
+"""
+Persistent store of text embeddings for the preprocessing, so texts are only encoded once.
+
+Embeddings are keyed by an id (e.g. the entry_id of a document) and a hash of the text, in a folder per model.
+The store is a set of shards, each a float32 matrix and the keys of its rows in two .npy files.
+Newly encoded embeddings are appended as a new shard, and shards are merged once there are too many.
+"""
+
+import glob
+import hashlib
+import os
+import re
+
+import numpy as np
+
+
+class EmbeddingStore:
+
+    def __init__(self, folder, model_name, model_loader):
+        """
+        model_loader returns the embedding model, it is only called when there is something to encode
+        """
+        self.folder = os.path.join(folder, re.sub(r'[^\w.-]', '_', model_name))
+        self.model_loader = model_loader
+        self.model = None
+        os.makedirs(self.folder, exist_ok=True)
+        self.load()
+
+    def load(self):
+        self.shards = []
+        self.index = {}
+        for keys_path in sorted(glob.glob(os.path.join(self.folder, 'part-*.keys.npy'))):
+            keys = np.load(keys_path)
+            self.shards.append(np.load(keys_path.replace('.keys.npy', '.npy'), mmap_mode='r'))
+            self.index.update((key, (len(self.shards) - 1, row)) for row, key in enumerate(keys.tolist()))
+
+    @staticmethod
+    def key(id, text):
+        return f'{id}:{hashlib.sha1(text.encode()).hexdigest()[:16]}'
+
+    def encode(self, ids, texts):
+        """
+        Embeddings for texts (one row each), only encoding those which are not in the store yet
+        """
+        keys = [self.key(id, text) for id, text in zip(ids, texts)]
+        missing = {key: text for key, text in zip(keys, texts) if key not in self.index}
+        print(f'{len(keys) - len(missing)} of {len(keys)} embeddings found in store, encoding {len(missing)}')
+        if missing:
+            if self.model is None:
+                self.model = self.model_loader()
+            self.append(list(missing), self.model.encode(list(missing.values())))
+        return self.lookup(keys)
+
+    def lookup(self, keys):
+        locations = np.array([self.index[key] for key in keys], dtype=np.int64).reshape(-1, 2)
+        dim = self.shards[0].shape[1] if self.shards else 0
+        embeddings = np.empty((len(keys), dim), dtype=np.float32)
+        for shard_id, shard in enumerate(self.shards):
+            selected = locations[:, 0] == shard_id
+            if selected.any():
+                embeddings[selected] = shard[locations[selected, 1]]
+        return embeddings
+
+    def append(self, keys, embeddings):
+        """
+        Write a new shard. The keys file is written last, a shard without it is incomplete and ignored.
+        """
+        numbers = [int(re.search(r'part-(\d+)', p).group(1)) for p in glob.glob(os.path.join(self.folder, 'part-*.npy'))]
+        path = os.path.join(self.folder, f'part-{max(numbers, default=0) + 1:05d}')
+        for suffix, array in [('.npy', np.asarray(embeddings, dtype=np.float32)), ('.keys.npy', np.array(keys))]:
+            np.save(f'{path}.tmp{suffix}', array)
+            os.replace(f'{path}.tmp{suffix}', f'{path}{suffix}')
+        self.load()
+
+    def compact(self, keep_keys, max_shards=8):
+        """
+        Merge all shards into one with only the keys to keep, once there are more than max_shards
+        """
+        if len(self.shards) <= max_shards:
+            return
+        keep_keys = [key for key in dict.fromkeys(keep_keys) if key in self.index]
+        old_files = glob.glob(os.path.join(self.folder, 'part-*.npy'))
+        self.append(keep_keys, self.lookup(keep_keys))
+        # keys files first, so an interrupted compaction leaves incomplete shards which are ignored
+        for path in sorted(old_files, key=lambda p: not p.endswith('.keys.npy')):
+            os.remove(path)
+        self.load()
+        print(f'Compacted embedding store to {len(keep_keys)} embeddings')
@@ -1,7 +1,15 @@
+import contextlib
+import json
+import os
+
 import joblib
 import numpy as np
+import pandas as pd
 from sentence_transformers import SentenceTransformer
 
+from scoring_model.embedding_backend import optimize
+from scoring_model.embedding_cache import encode_cached
+
 
 def load_scoring_model(model_path):
     """
@@ -11,11 +19,30 @@ def load_scoring_model(model_path):
     return model
 
 
-def load_model(model_path):
+def load_scorer(model_path):
     """
-    Load sentence transformer model
+    Scorer of the model, from its exported linear form (<model>.json) if there is one at least as new as the model.
+    Models are loaded with load_scoring_model otherwise, and fused if they are linear.
+    """
+    export_path = linear_export_path(model_path)
+    if os.path.exists(export_path) and (not os.path.exists(model_path)
+                                        or os.path.getmtime(export_path) >= os.path.getmtime(model_path)):
+        return LinearScorer.load(export_path)
+    model = load_scoring_model(model_path)
+    return LinearScorer.from_model(model) or ModelScorer(model)
+
+
+def linear_export_path(model_path):
+    return os.path.splitext(model_path)[0] + '.json'
+
+
+def load_model(model_path, backend_config=None, check_parity=True):
+    """
+    Load sentence transformer model, set up for CPU inference with the embedding_backend config if given
     """
     model = SentenceTransformer(model_path)
+    if backend_config is not None:
+        model = optimize(model, backend_config, check_parity)
     return model
 
 
@@ -31,37 +58,240 @@ def similarity(l1, l2):
     return sim.tolist()
 
 
+def embedding_matrix(embeddings):
+    """
+    Stack a column of embeddings into a contiguous, read-only float32 matrix
+    """
+    matrix = np.ascontiguousarray(np.vstack(embeddings), dtype=np.float32)
+    matrix.setflags(write=False)
+    return matrix
+
+
+def top_k(scores, k, offset=0):
+    """
+    Row indices of the scores ranked offset to offset + k, best first.
+    Only the best offset + k scores are selected (argpartition) and sorted, not the whole array.
+    """
+    end = min(offset + k, len(scores))
+    if end <= offset:
+        return np.empty(0, dtype=np.int64)
+    if end < len(scores):
+        rows = np.argpartition(-scores, end - 1)[:end]
+    else:
+        rows = np.arange(len(scores))
+    rows = rows[np.argsort(-scores[rows], kind='stable')]
+    return rows[offset:end]
+
+
+class ModelScorer:
+    """
+    Scores of a model on the similarity features, computed by its predict_proba
+    """
+
+    def __init__(self, model):
+        self.model = model
+
+    def __call__(self, document_embeddings, query_embeddings, title_embeddings):
+        qe_score = (document_embeddings @ query_embeddings.T).T
+        te_score = (document_embeddings @ title_embeddings.T).T
+        features = pd.DataFrame({'qe_score': qe_score.ravel(), 'te_score': te_score.ravel()})
+        return self.model.predict_proba(features)[:, 1].reshape(qe_score.shape)
+
+
+class LinearScorer:
+    """
+    Logistic model on the similarity features, sigmoid(w_q * (E @ q) + w_t * (E @ t) + b).
+    Since both features are linear in the document embeddings E, this is sigmoid(E @ (w_q * q + w_t * t) + b),
+    which is computed in a single matrix product, without any feature table.
+    The model is exported as json with its coefficients, intercept and features.
+    """
+    FEATURES = ('qe_score', 'te_score')
+
+    def __init__(self, coef, intercept, features=FEATURES):
+        weights = dict(zip(features, coef))
+        self.query_weight = np.float32(weights.get('qe_score', 0.0))
+        self.title_weight = np.float32(weights.get('te_score', 0.0))
+        self.coef = [float(c) for c in coef]
+        self.intercept = float(intercept)
+        self.features = list(features)
+
+    @classmethod
+    def from_model(cls, model):
+        """
+        Linear scorer of a fitted binary logistic regression on the similarity features, None for other models
+        """
+        is_logistic = type(model).__name__ == 'LogisticRegression' \
+            or getattr(model, 'loss', None) in ('log_loss', 'log')
+        features = list(getattr(model, 'feature_names_in_', cls.FEATURES))
+        if not is_logistic or not hasattr(model, 'coef_') or list(getattr(model, 'classes_', [])) != [0, 1] \
+                or np.shape(model.coef_) != (1, len(features)) or not set(features) <= set(cls.FEATURES):
+            return None
+        return cls(model.coef_[0], model.intercept_[0], features)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            spec = json.load(f)
+        return cls(spec['coef'], spec['intercept'], spec['features'])
+
+    def save(self, path):
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump({'type': 'logistic', 'features': self.features, 'coef': self.coef,
+                       'intercept': self.intercept}, f)
+        os.replace(f'{path}.tmp', path)
+
+    def user_weights(self, query_embeddings, title_embeddings):
+        """
+        w_q * q + w_t * t, documents are ranked by their inner product with it
+        """
+        return self.query_weight * query_embeddings + self.title_weight * title_embeddings
+
+    def __call__(self, document_embeddings, query_embeddings, title_embeddings):
+        user_weights = self.user_weights(query_embeddings, title_embeddings)
+        logits = (document_embeddings @ user_weights.T).T + np.float32(self.intercept)
+        # sigmoid, without overflow for large negative logits
+        return np.exp(-np.logaddexp(0, -logits))
+
+
 class RecommendationModel:
 
-    def __init__(self, embedding_model, scoring_model):
+    def __init__(self, embedding_model, scorer, query_cache=None, title_cache=None, timer=None):
+        """
+        scorer computes the scores of documents for users from their embeddings, see load_scorer.
+        timer(stage) returns a context manager around each stage of a request, e.g. to measure its latency.
+        """
         self.embedding_model = embedding_model
-        self.scoring_model = scoring_model
+        self.scorer = scorer
+        self.query_cache = query_cache
+        self.title_cache = title_cache
+        self.timer = timer or (lambda stage: contextlib.nullcontext())
 
-    def rerank_list(self, query, ids, titles):
+    def rerank_list(self, query, ids, titles, stored_embedding=None):
         """
         Rerank document ids by embedding similarity between query and title.
+        Title embeddings are looked up with stored_embedding(id) for known documents, only unknown titles
+        are encoded. Encoded queries and titles are cached.
         A personalized ranking could be implemented as well.
             E.g. use the recommender model to score known ids. Features of new documents would have to be imputed,
             and the query be incorporated as an additional feature.
         """
-        query_embedding = self.embedding_model.encode([query])
-        title_embeddings = self.embedding_model.encode(titles)
-        similarities = similarity(query_embedding, title_embeddings)
-        sorted_ids = [id for _, id in sorted(zip(similarities, ids), reverse=True)]
+        if not ids:
+            return []
+        with self.timer('encode_query'):
+            query_embedding = encode_cached(self.embedding_model, [query], self.query_cache)[0]
+        title_embeddings = [stored_embedding(id) if stored_embedding else None for id in ids]
+        unknown = [i for i, embedding in enumerate(title_embeddings) if embedding is None]
+        with self.timer('encode_titles'):
+            encoded = encode_cached(self.embedding_model, [titles[i] for i in unknown], self.title_cache)
+        for i, embedding in zip(unknown, encoded):
+            title_embeddings[i] = embedding
+        with self.timer('similarity'):
+            similarities = similarity([query_embedding], np.array(title_embeddings, dtype=np.float32))
+            sorted_ids = [id for _, id in sorted(zip(similarities, ids), reverse=True)]
         return sorted_ids
 
-    def score(self, document_features, user_features):
+    def user_embeddings(self, user_features):
         """
-        Return score of a document for a user. This is a pointwise model scoring each document individually.
+        Query and title embedding of a user, taken from the precomputed user features.
+        The embedding model only runs as a fallback for users without stored embeddings.
         """
-        document_embeddings = np.array(document_features['title_embeddings'].values.tolist())
+        query_embeddings, title_embeddings = self.user_embeddings_batch([user_features])
+        return query_embeddings[0], title_embeddings[0]
 
-        query_embeddings = self.embedding_model.encode([user_features['query']])
-        document_features['qe_score'] = similarity(document_embeddings, query_embeddings)
+    def user_embeddings_batch(self, users_features):
+        """
+        Query and title embedding matrices with one row per user. Missing embeddings of all users
+        are encoded in a single call.
+        """
+        keys = ['query', 'title']
+        embeddings = [[features.get(f'{key}_embedding') for key in keys] for features in users_features]
+        missing = [(u, j) for u, user in enumerate(embeddings) for j, embedding in enumerate(user) if embedding is None]
+        if missing:
+            encoded = self.embedding_model.encode([users_features[u][keys[j]] for u, j in missing])
+            for (u, j), embedding in zip(missing, encoded):
+                embeddings[u][j] = embedding
+        return (np.array([user[0] for user in embeddings], dtype=np.float32),
+                np.array([user[1] for user in embeddings], dtype=np.float32))
 
-        title_embeddings = self.embedding_model.encode([user_features['title']])
-        document_features['te_score'] = similarity(document_embeddings, title_embeddings)
+    def score(self, document_embeddings, user_embeddings):
+        """
+        Return score of each document (row of the embedding matrix) for a user.
+        This is a pointwise model scoring each document individually.
+        For matrices of user embeddings, the scores of all users x documents are returned, one row per user.
+        """
+        query_embeddings, title_embeddings = user_embeddings
+        return self.scorer(document_embeddings, query_embeddings, title_embeddings)
 
-        document_features['score'] = self.scoring_model.predict_proba(document_features[['qe_score', 'te_score']])[:, 1]
-        document_features.sort_values(by='score', ascending=False, inplace=True)
-        return document_features
\ No newline at end of file
+    def retrieval_queries(self, user_embeddings):
+        """
+        Vectors to retrieve candidates for a user with. A linear scorer ranks documents by their inner product
+        with w_q * q + w_t * t, so candidates are retrieved with this single vector. For other scorers (or a
+        linear one ignoring both embeddings), they are retrieved with the query and the title embedding.
+        """
+        query_embedding, title_embedding = user_embeddings
+        if isinstance(self.scorer, LinearScorer):
+            user_weights = self.scorer.user_weights(query_embedding, title_embedding)
+            if np.any(user_weights):
+                return user_weights[np.newaxis]
+        return np.stack([query_embedding, title_embedding])
+
+    def rank(self, document_embeddings, user_embeddings, k, offset=0, rows=None):
+        """
+        Rows of the documents ranked offset to offset + k, among all documents or only the given rows
+        """
+        if rows is not None and len(rows) == 0:
+            return rows
+        with self.timer('score'):
+            scores = self.score(document_embeddings if rows is None else document_embeddings[rows], user_embeddings)
+        with self.timer('top_k'):
+            ranked = top_k(scores, k, offset)
+        return ranked if rows is None else rows[ranked]
+
+    def recommend(self, document_embeddings, user_features, k, offset=0, candidate_index=None, n_candidates=200,
+                  evaluate=False, allowed=None):
+        """
+        Rows of the documents ranked offset to offset + k for a user.
+        With a candidate index, only the documents it retrieves for the user (see retrieval_queries) are scored.
+        With allowed (a boolean mask of rows, e.g. of a metadata filter), only allowed documents are retrieved
+        and scored. If there are no more of them than candidates, they are all scored without the index.
+        In evaluation mode, all (allowed) documents are scored as well to report how many of the exact results
+        were found.
+        """
+        with self.timer('user_embeddings'):
+            user_embeddings = self.user_embeddings(user_features)
+        allowed_rows = None if allowed is None else np.flatnonzero(allowed)
+        n_candidates = max(n_candidates, offset + k)
+        if candidate_index is None or (allowed_rows is not None and len(allowed_rows) <= n_candidates):
+            return self.rank(document_embeddings, user_embeddings, k, offset, allowed_rows)
+        with self.timer('retrieve'):
+            candidates = candidate_index.candidates(self.retrieval_queries(user_embeddings), n_candidates, allowed)
+        rows = self.rank(document_embeddings, user_embeddings, k, offset, candidates)
+        if evaluate:
+            embeddings = document_embeddings if allowed_rows is None else document_embeddings[allowed_rows]
+            exact_rows = top_k(self.score(embeddings, user_embeddings), k, offset)
+            if allowed_rows is not None:
+                exact_rows = allowed_rows[exact_rows]
+            print(f'Candidate recall: {len(np.intersect1d(rows, exact_rows)) / max(len(exact_rows), 1):.3f}')
+        return rows
+
+    def recommend_batch(self, document_embeddings, users_features, k, block_size=256, allowed=None):
+        """
+        Rows of the best k documents for each of many users. All documents (or the allowed ones, given by a
+        boolean mask of rows) are scored, for blocks of users at once with a single matrix product each.
+        """
+        with self.timer('user_embeddings'):
+            query_embeddings, title_embeddings = self.user_embeddings_batch(users_features)
+        allowed_rows = None if allowed is None else np.flatnonzero(allowed)
+        if allowed_rows is not None:
+            if len(allowed_rows) == 0:
+                return [allowed_rows] * len(users_features)
+            document_embeddings = document_embeddings[allowed_rows]
+        rows = []
+        for start in range(0, len(users_features), block_size):
+            block = slice(start, start + block_size)
+            with self.timer('score'):
+                scores = self.score(document_embeddings, (query_embeddings[block], title_embeddings[block]))
+            with self.timer('top_k'):
+                ranked = [top_k(user_scores, k) for user_scores in scores]
+            rows.extend(ranked if allowed_rows is None else [allowed_rows[r] for r in ranked])
+        return rows
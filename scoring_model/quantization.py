@@ -0,0 +1,175 @@
+"""
+Compact storage of document embeddings as float16, or int8 with one scale factor per embedding.
+
+Quantized embeddings are about 2x (float16) or 4x (int8) smaller than float32, on disk and in memory.
+Products with query vectors are computed with a float32 BLAS product per block of rows, converted into a buffer
+small enough to stay in the CPU cache, so no float32 copy of the matrix is ever made.
+- int8 reads a quarter of the memory of float32, and its products are about as fast (or faster, as they are
+  memory-bound for a few queries).
+- float16 only saves memory: numpy converts it to float32 slowly, its products are several times slower.
+Run this script to check how much the ranking changes compared to float32.
+"""
+
+import os
+import sys
+
+import numpy as np
+
+sys.path.append('..')
+from scoring_model.model_utils import top_k
+
+DTYPES = {'float32': np.float32, 'float16': np.float16, 'int8': np.int8}
+
+
+class QuantizedEmbeddings:
+    """
+    Read-only embedding matrix in float16 or int8 (with scales), used like a float32 numpy array:
+    indexing returns float32 rows and matrix @ vectors returns float32 products.
+    """
+
+    def __init__(self, codes, scales=None, block_size=256):
+        self.codes = codes
+        self.scales = scales
+        self.block_size = block_size
+
+    @classmethod
+    def quantize(cls, embeddings, dtype):
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if dtype == 'float16':
+            return cls(embeddings.astype(np.float16))
+        if dtype == 'int8':
+            scales = np.abs(embeddings).max(axis=1) / 127
+            scales[scales == 0] = 1
+            codes = np.round(embeddings / scales[:, None]).astype(np.int8)
+            return cls(codes, scales.astype(np.float32))
+        raise ValueError(f'Unknown embedding dtype {dtype}')
+
+    @property
+    def dtype(self):
+        return self.codes.dtype
+
+    @property
+    def shape(self):
+        return self.codes.shape
+
+    @property
+    def nbytes(self):
+        return self.codes.nbytes + (self.scales.nbytes if self.scales is not None else 0)
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, item):
+        rows = self.codes[item].astype(np.float32)
+        if self.scales is not None:
+            rows *= np.expand_dims(self.scales[item], -1)
+        return rows
+
+    def __matmul__(self, other):
+        """
+        Products of all embeddings with a vector (d,) or the columns of a matrix (d, u)
+        """
+        other = np.asarray(other, dtype=np.float32)
+        result = np.empty((len(self),) + other.shape[1:], dtype=np.float32)
+        buffer = np.empty((min(self.block_size, len(self)), self.shape[1]), dtype=np.float32)
+        for start in range(0, len(self), self.block_size):
+            codes = self.codes[start:start + self.block_size]
+            rows = buffer[:len(codes)]
+            np.copyto(rows, codes, casting='unsafe')
+            np.dot(rows, other, out=result[start:start + len(codes)])
+        if self.scales is not None:
+            result *= self.scales.reshape((-1,) + (1,) * (other.ndim - 1))
+        return result
+
+
+def scales_path(path):
+    return path[:-len('.npy')] + '_scales.npy'
+
+
+def save_embeddings(path, embeddings, dtype='float32'):
+    """
+    Write embeddings as .npy file in the given dtype, int8 scales go to a second file.
+    Files are replaced atomically, so readers never see a partial file.
+    """
+    files = {path: np.asarray(embeddings, dtype=np.float32)}
+    if dtype != 'float32':
+        quantized = QuantizedEmbeddings.quantize(embeddings, dtype)
+        files = {path: quantized.codes}
+        if quantized.scales is not None:
+            files[scales_path(path)] = quantized.scales
+    # the main file goes last, as its modification time tells readers the data is complete
+    for file_path, array in reversed(files.items()):
+        tmp_path = f'{file_path}.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, file_path)
+
+
+def load_embeddings(path, mmap=True, dtype=None):
+    """
+    Load embeddings written with save_embeddings, memory-mapped if requested.
+    With a dtype, they are converted to it if stored differently.
+    """
+    codes = np.load(path, mmap_mode='r' if mmap else None)
+    if codes.dtype == np.int8:
+        embeddings = QuantizedEmbeddings(codes, np.load(scales_path(path), mmap_mode='r' if mmap else None))
+    elif codes.dtype == np.float16:
+        embeddings = QuantizedEmbeddings(codes)
+    else:
+        embeddings = codes
+    return convert_embeddings(embeddings, dtype)
+
+
+def convert_embeddings(embeddings, dtype=None):
+    """
+    Embeddings in the given dtype ('float32', 'float16' or 'int8'), unchanged if they already are or no dtype is given
+    """
+    if dtype is None or embeddings.dtype == DTYPES[dtype]:
+        return embeddings
+    if dtype == 'float32':
+        return embeddings[:]
+    if isinstance(embeddings, QuantizedEmbeddings):
+        embeddings = embeddings[:]
+    return QuantizedEmbeddings.quantize(embeddings, dtype)
+
+
+def ranking_change(embeddings, queries, dtype, k=(10, 100)):
+    """
+    Overlap of the top k documents for each query between float32 and quantized embeddings,
+    and the largest absolute change of a similarity
+    """
+    quantized = QuantizedEmbeddings.quantize(embeddings, dtype)
+    overlaps = {n: [] for n in k}
+    max_error = 0
+    for query in queries:
+        exact, approximate = embeddings @ query, quantized @ query
+        max_error = max(max_error, float(np.abs(exact - approximate).max()))
+        for n in k:
+            overlaps[n].append(len(np.intersect1d(top_k(exact, n), top_k(approximate, n))) / min(n, len(exact)))
+    return {n: float(np.mean(o)) for n, o in overlaps.items()}, max_error, quantized.nbytes
+
+
+def evaluate(n_queries=200):
+    """
+    Report memory and ranking changes of float16 and int8 against float32 embeddings of the latest documents,
+    with user embeddings (or random documents) as queries
+    """
+    import pandas as pd
+    from feature_store import feature_definitions as fd
+    embeddings = np.vstack(pd.read_parquet(fd.local_file_paths['documents'], columns=['title_embeddings'])
+                           ['title_embeddings'].values).astype(np.float32)
+    rng = np.random.default_rng(0)
+    if os.path.exists(fd.local_file_paths['user']):
+        users = pd.read_parquet(fd.local_file_paths['user'], columns=['user_query_embeddings', 'user_title_embeddings'])
+        queries = np.vstack(list(users['user_query_embeddings']) + list(users['user_title_embeddings']))
+    else:
+        queries = embeddings
+    queries = queries[rng.choice(len(queries), min(n_queries, len(queries)), replace=False)].astype(np.float32)
+    print(f'{len(embeddings)} documents, float32: {embeddings.nbytes / 2 ** 20:.1f} MiB')
+    for dtype in ['float16', 'int8']:
+        overlaps, max_error, nbytes = ranking_change(embeddings, queries, dtype)
+        overlap = ', '.join(f'top {n} overlap: {o:.3f}' for n, o in overlaps.items())
+        print(f'{dtype}: {nbytes / 2 ** 20:.1f} MiB, {overlap}, max similarity error: {max_error:.5f}')
+
+
+if __name__ == '__main__':
+    evaluate()
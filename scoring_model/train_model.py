@@ -6,17 +6,27 @@ or even prompt-based prediction to an LLM API.
 Here this is just a dummy-model for testing the system.
 """
 
+import datetime
+import glob
 import joblib
 import os
+from concurrent.futures import ProcessPoolExecutor
 
+import numpy as np
 import pandas as pd
+import pyarrow.parquet as pq
 
 
 from sklearn.utils import resample
-from sklearn.linear_model import LogisticRegression
+from sklearn.linear_model import LogisticRegression, SGDClassifier
 import utils
+from preprocessing.event_store import load_events
 
-from model_utils import similarity
+from model_utils import LinearScorer, linear_export_path
+
+PREPROCESSING_DIR = os.path.join(utils.base_folder(), 'data', 'preprocessing')
+TRAINING_DIR = os.path.join(utils.base_folder(), 'data', 'training')
+FEATURES = ['qe_score', 'te_score']
 
 
 def upsample(train_df):
@@ -34,34 +44,78 @@ def upsample(train_df):
     return pd.concat([df_majority, df_minority_upsampled])
 
 
-def trainings_data(num_days):
+def embedding_column(table, column):
+    """
+    A column of equally long embedding lists of an arrow table as float32 matrix, without python objects
+    """
+    values = table.column(column).combine_chunks()
+    return values.flatten().to_numpy().astype(np.float32).reshape(len(values), -1)
+
+
+def featurize_day(ds, features_dir, block_size=65536):
+    """
+    Features and labels of the interactions of a day, from the user and document features of that day.
+    They are saved to features_dir, returns the number of negative and positive labels.
+    Interactions with users or documents without features are skipped.
+    """
+    try:
+        documents = pq.read_table(os.path.join(PREPROCESSING_DIR, f'{ds}_document_features.parquet'),
+                                  columns=['entry_id', 'title_embeddings'])
+        users = pq.read_table(os.path.join(PREPROCESSING_DIR, f'{ds}_user_features.parquet'),
+                              columns=['user_id', 'user_query_embeddings', 'user_title_embeddings'])
+    except FileNotFoundError:
+        print(f'No data for {ds}, skipping')
+        return np.zeros(2, dtype=np.int64)
+    logs = load_events(ds, utils.date_to_str(utils.str_to_date(ds) + datetime.timedelta(days=1)),
+                       columns=['user_id', 'action', 'result'])
+    document_rows = pd.Index(documents.column('entry_id').to_pylist()).get_indexer(logs['result'].astype(object))
+    user_rows = pd.Index(users.column('user_id').to_pylist()).get_indexer(logs['user_id'].astype(object))
+    known = (document_rows >= 0) & (user_rows >= 0)
+    document_rows, user_rows = document_rows[known], user_rows[known]
+
+    title_embeddings = embedding_column(documents, 'title_embeddings')
+    query_embeddings = embedding_column(users, 'user_query_embeddings')
+    user_title_embeddings = embedding_column(users, 'user_title_embeddings')
+    X = np.empty((len(document_rows), len(FEATURES)), dtype=np.float32)
+    # row-wise dot products, in blocks to bound the size of the gathered embeddings
+    for start in range(0, len(document_rows), block_size):
+        rows = slice(start, start + block_size)
+        E = title_embeddings[document_rows[rows]]
+        X[rows, 0] = np.einsum('ij,ij->i', query_embeddings[user_rows[rows]], E)
+        X[rows, 1] = np.einsum('ij,ij->i', user_title_embeddings[user_rows[rows]], E)
+    y = logs['action'].isin(['click', 'expand']).to_numpy()[known].astype(np.int8)
+    np.savez(os.path.join(features_dir, f'{ds}.npz'), X=X, y=y)
+    print(f'Featurized {len(y)} interactions of {ds}')
+    return np.bincount(y, minlength=2)
+
+
+def featurize_days(days, features_dir, workers=4):
+    """
+    Featurize days in parallel processes, returns the number of negative and positive labels
+    """
+    os.makedirs(features_dir, exist_ok=True)
+    for path in glob.glob(os.path.join(features_dir, '*.npz')):
+        os.remove(path)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return sum(pool.map(featurize_day, days, [features_dir] * len(days)), np.zeros(2, dtype=np.int64))
+
+
+def trainings_data(num_days, workers=4):
     """
     Prepare trainings data from logs and historicl user features and document features.
     Features should be the same used for inference in the backend and might be prepared in the feature store
     alternatively.
     """
-    folder = os.path.join(utils.base_folder(), 'data', 'preprocessing')
+    features_dir = os.path.join(TRAINING_DIR, 'features')
+    featurize_days(utils.last_date_strings(num_days), features_dir, workers)
     train_df = []
-    for ds in utils.last_date_strings(num_days):
-        try:
-            df = pd.read_parquet(os.path.join(folder, f'{ds}_document_features.parquet'))
-            uf = pd.read_parquet(os.path.join(folder, f'{ds}_user_features.parquet'))
-            logs = pd.read_parquet(os.path.join(folder, f'{ds}_logs.parquet'))
-        except FileNotFoundError as e:
-            print(f'No data for {ds}, skipping')
-            continue
-
-        tdf = pd.merge(logs, uf, on='user_id', how='left')
-        tdf = pd.merge(tdf, df[['entry_id', 'title_embeddings']], left_on='result', right_on='entry_id', how='left', )
-        tdf['label'] = tdf['action'].isin(['click', 'expand']).astype(int)
-        tdf.dropna(subset=['user_id', 'entry_id'], inplace=True)
-        tdf['qe_score'] = similarity(tdf['user_query_embeddings'].values.tolist(), tdf['title_embeddings'].values.tolist())
-        tdf['te_score'] = similarity(tdf['user_title_embeddings'].values.tolist(), tdf['title_embeddings'].values.tolist())
-        train_df.append(tdf)
+    for path in sorted(glob.glob(os.path.join(features_dir, '*.npz'))):
+        with np.load(path) as day:
+            train_df.append(pd.DataFrame(day['X'], columns=FEATURES).assign(label=day['y']))
 
     train_df = pd.concat(train_df)
     train_df = upsample(train_df)
-    X = train_df[['qe_score', 'te_score']]
+    X = train_df[FEATURES]
     y = train_df['label']
     return X, y
 
@@ -72,11 +126,59 @@ def train_model(X, y):
     """
     logistic_model = LogisticRegression()
     logistic_model.fit(X, y)
-    joblib.dump(logistic_model, os.path.join(utils.base_folder(), 'data', 'training', f'scoring_model_{utils.today_str()}.pkl'))
+    save_model(logistic_model)
+
+
+def train_streaming(num_days, workers=4, epochs=5, batch_size=100000, alpha=0.0001):
+    """
+    Train a logistic regression by stochastic gradient descent, in bounded memory.
+    Days are featurized to files in parallel, then streamed in batches for each epoch.
+    Instead of upsampling, the classes are balanced by sample weights from their counts.
+    """
+    features_dir = os.path.join(TRAINING_DIR, 'features')
+    counts = featurize_days(utils.last_date_strings(num_days), features_dir, workers)
+    if counts.min() == 0:
+        raise ValueError(f'Training needs interactions with and without clicks, found {counts.tolist()}')
+    class_weights = counts.sum() / (2 * counts)
+    print(f'Training on {counts.sum()} interactions, {counts[1]} positive')
+
+    model = SGDClassifier(loss='log_loss', alpha=alpha, random_state=42)
+    rng = np.random.default_rng(42)
+    paths = sorted(glob.glob(os.path.join(features_dir, '*.npz')))
+    for epoch in range(epochs):
+        for path in rng.permutation(paths):
+            with np.load(path) as day:
+                X, y = day['X'], day['y']
+            order = rng.permutation(len(y))
+            for start in range(0, len(y), batch_size):
+                rows = order[start:start + batch_size]
+                model.partial_fit(pd.DataFrame(X[rows], columns=FEATURES), y[rows], classes=[0, 1],
+                                  sample_weight=class_weights[y[rows]])
+        print(f'Epoch {epoch + 1} of {epochs} done')
+    save_model(model)
+
+
+def save_model(model):
+    """
+    Save the model, and linear models exported for serving as well
+    """
+    path = os.path.join(TRAINING_DIR, f'scoring_model_{utils.today_str()}.pkl')
+    joblib.dump(model, path)
+    scorer = LinearScorer.from_model(model)
+    if scorer is not None:
+        scorer.save(linear_export_path(path))
+        print(f'Exported model for serving to {linear_export_path(path)}')
 
 
 if __name__ == '__main__':
     print('Retraining model')
-    X, y = trainings_data(num_days=5)
-    train_model(X, y)
-
+    training_config = utils.load_config().get('training', {})
+    num_days = training_config.get('num_days', 5)
+    workers = training_config.get('workers', 4)
+    if training_config.get('method', 'sgd') == 'sgd':
+        train_streaming(num_days, workers, epochs=training_config.get('epochs', 5),
+                        batch_size=training_config.get('batch_size', 100000),
+                        alpha=training_config.get('alpha', 0.0001))
+    else:
+        X, y = trainings_data(num_days, workers)
+        train_model(X, y)
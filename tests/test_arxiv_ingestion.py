@@ -0,0 +1,75 @@
+"""
+Download of arxiv partitions with a local stand-in for the arxiv client
+"""
+
+import datetime
+import os
+import re
+import sys
+import threading
+import time
+from types import SimpleNamespace
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'preprocessing'))
+from arxiv_ingestion import RateLimiter, fetch_partitions, partition_path
+
+DAYS = [datetime.date(2024, 10, 24), datetime.date(2024, 10, 25)]
+TOPICS = ['cs.AI', 'cs.CL']
+INTERVAL_S = 0.1
+
+
+class FakeClient:
+    """
+    Returns one article per search and records the partitions and times of requests, failing for some partitions
+    """
+
+    def __init__(self, requests, failing=()):
+        self.requests = requests
+        self.failing = failing
+
+    def results(self, search):
+        topic, day = re.match(r'cat:(\S+) AND submittedDate:\[(\d{8})', search.query).groups()
+        day = datetime.datetime.strptime(day, '%Y%m%d').date()
+        self.requests.append((time.monotonic(), topic, day))
+        if (topic, day) in self.failing:
+            raise ConnectionError(f'{topic} {day} unavailable')
+        published = datetime.datetime.combine(day, datetime.time(12), tzinfo=datetime.timezone.utc)
+        yield SimpleNamespace(entry_id=f'http://arxiv.org/abs/{topic}-{day}', updated=published, published=published,
+                              title=f'An article on {topic}', authors=[SimpleNamespace(name='A. Author')],
+                              categories=[topic], comment=None, primary_category=topic, journal_ref=None,
+                              summary='Summary', doi=None)
+
+
+def fetch(output_dir, requests, failing=()):
+    lock = threading.Lock()
+
+    def client_factory():
+        with lock:
+            return FakeClient(requests, failing)
+    return fetch_partitions(TOPICS, DAYS, str(output_dir), client_factory=client_factory,
+                            rate_limiter=RateLimiter(INTERVAL_S), max_workers=4)
+
+
+def test_rerun_fetches_only_failed_partitions(tmp_path):
+    requests = []
+    failed = fetch(tmp_path, requests, failing=[('cs.CL', DAYS[1])])
+    assert failed == [('cs.CL', DAYS[1])]
+    assert len(requests) == len(TOPICS) * len(DAYS)
+    for topic in TOPICS:
+        for day in DAYS:
+            exists = os.path.exists(partition_path(str(tmp_path), day.strftime('%Y-%m-%d'), topic))
+            assert exists == ((topic, day) != ('cs.CL', DAYS[1]))
+
+    requests = []
+    assert fetch(tmp_path, requests) == []
+    assert [(topic, day) for _, topic, day in requests] == [('cs.CL', DAYS[1])]
+    assert os.path.exists(partition_path(str(tmp_path), DAYS[1].strftime('%Y-%m-%d'), 'cs.CL'))
+
+
+def test_requests_of_all_workers_are_spaced_by_the_interval(tmp_path):
+    requests = []
+    fetch(tmp_path, requests)
+    times = sorted(t for t, _, _ in requests)
+    assert len(times) == len(TOPICS) * len(DAYS)
+    # sleeping may overshoot a little, so two requests can be slightly closer than the interval
+    assert min(later - earlier for earlier, later in zip(times, times[1:])) >= 0.8 * INTERVAL_S
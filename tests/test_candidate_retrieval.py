@@ -0,0 +1,30 @@
+"""
+Candidates retrieved for the recommendations of a user, against scoring all documents
+"""
+
+import os
+import sys
+
+import numpy as np
+import pytest
+
+pytest.importorskip('sentence_transformers')
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+from scoring_model.candidate_index import ExactIndex
+from scoring_model.model_utils import LinearScorer, RecommendationModel
+
+
+def normalized(rng, shape):
+    embeddings = rng.standard_normal(shape).astype(np.float32)
+    return embeddings / np.linalg.norm(embeddings, axis=-1, keepdims=True)
+
+
+def test_linear_scorer_retrieves_the_exact_top_k():
+    rng = np.random.default_rng(0)
+    documents = normalized(rng, (2000, 32))
+    recommender = RecommendationModel(None, LinearScorer([3.0, -1.0], 0.5))
+    for _ in range(20):
+        user = {'query_embedding': normalized(rng, 32), 'title_embedding': normalized(rng, 32)}
+        exact = recommender.recommend(documents, user, 10)
+        retrieved = recommender.recommend(documents, user, 10, candidate_index=ExactIndex(documents), n_candidates=10)
+        assert retrieved.tolist() == exact.tolist()
@@ -0,0 +1,72 @@
+"""
+Batched encoding of concurrent requests, stopped while requests are pending
+"""
+
+import asyncio
+import os
+import sys
+import threading
+
+import numpy as np
+import pytest
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'ranking_service'))
+from encoding import EncodingScheduler
+
+
+class SlowModel:
+
+    def __init__(self):
+        self.started = threading.Event()
+        self.release = threading.Event()
+
+    def encode(self, texts):
+        self.started.set()
+        self.release.wait(5)
+        return np.zeros((len(texts), 2), dtype=np.float32)
+
+
+def test_stop_fails_pending_requests():
+    async def run():
+        model = SlowModel()
+        scheduler = EncodingScheduler(model, max_batch_size=1, max_wait_ms=0)
+        scheduler.start()
+        # the first request is being encoded, the second one waits in the queue
+        encoding = asyncio.ensure_future(scheduler.encode_async(['first']))
+        queued = asyncio.ensure_future(scheduler.encode_async(['second']))
+        await asyncio.get_running_loop().run_in_executor(None, model.started.wait, 5)
+        await scheduler.stop()
+        model.release.set()
+        for request in [encoding, queued]:
+            with pytest.raises(RuntimeError):
+                await asyncio.wait_for(request, 1)
+        with pytest.raises(RuntimeError):
+            await scheduler.encode_async(['after stop'])
+    asyncio.run(run())
+
+
+def test_stop_fails_blocked_threads():
+    async def run():
+        model = SlowModel()
+        scheduler = EncodingScheduler(model, max_batch_size=1, max_wait_ms=0)
+        scheduler.start()
+        errors = []
+
+        def encode():
+            try:
+                scheduler.encode(['text'])
+            except RuntimeError as e:
+                errors.append(e)
+        threads = [threading.Thread(target=encode) for _ in range(3)]
+        for thread in threads:
+            thread.start()
+        await asyncio.get_running_loop().run_in_executor(None, model.started.wait, 5)
+        # one request is being encoded, the others wait in the queue
+        while scheduler.queue.qsize() < 2:
+            await asyncio.sleep(0.01)
+        await scheduler.stop()
+        model.release.set()
+        for thread in threads:
+            await asyncio.get_running_loop().run_in_executor(None, thread.join, 5)
+        assert len(errors) == 3
+    asyncio.run(run())
@@ -0,0 +1,63 @@
+"""
+Ingestion of frontend logs into the event store, and deduplication of repeated events
+"""
+
+import json
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('sentence_transformers')
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'preprocessing'))
+from event_store import load_events
+from log_ingestion import ingest_logs
+
+
+def log_line(time, user_id, action, result, query='llm'):
+    event = {'user_id': user_id, 'action': action, 'result': result, 'query': query}
+    return f'{time},000 INFO {json.dumps(event)}\n'
+
+
+def write_log(path, lines):
+    with open(path, 'w') as f:
+        f.writelines(lines)
+
+
+def test_events_are_counted_once_per_day(tmp_path):
+    log_dir, events_dir = tmp_path / 'logs', tmp_path / 'events'
+    log_dir.mkdir()
+    write_log(log_dir / '2024-10-25.log', [
+        log_line('2024-10-25 10:00:00', 'u1', 'click', 'a'),
+        # reloaded within the dedup window, and much later
+        log_line('2024-10-25 10:00:30', 'u1', 'click', 'a'),
+        log_line('2024-10-25 18:00:00', 'u1', 'click', 'a'),
+        log_line('2024-10-25 18:00:00', 'u1', 'expand', 'a'),
+        # the same event on the next day is another one
+        log_line('2024-10-26 09:00:00', 'u1', 'click', 'a'),
+    ])
+    # logged again in another log file of the day
+    write_log(log_dir / '2024-10-25_2.log', [
+        log_line('2024-10-25 12:00:00', 'u1', 'click', 'a'),
+        log_line('2024-10-25 12:00:00', 'u2', 'click', 'a'),
+    ])
+    ingest_logs(str(log_dir), str(events_dir), str(tmp_path / 'state.json'), workers=1, dedup_window_s=300)
+
+    events = load_events('2024-10-25', '2024-10-27', events_dir=str(events_dir))
+    counts = events.astype(str).groupby(['date', 'user_id', 'action']).size().to_dict()
+    assert counts == {('2024-10-25', 'u1', 'click'): 1, ('2024-10-25', 'u1', 'expand'): 1,
+                      ('2024-10-25', 'u2', 'click'): 1, ('2024-10-26', 'u1', 'click'): 1}
+
+
+def test_appended_repetitions_are_counted_once(tmp_path):
+    log_dir, events_dir = tmp_path / 'logs', tmp_path / 'events'
+    log_dir.mkdir()
+    path = log_dir / '2024-10-25.log'
+    write_log(path, [log_line('2024-10-25 10:00:00', 'u1', 'click', 'a')])
+    ingest_logs(str(log_dir), str(events_dir), str(tmp_path / 'state.json'), workers=1, dedup_window_s=300)
+    with open(path, 'a') as f:
+        f.write(log_line('2024-10-25 11:00:00', 'u1', 'click', 'a'))
+    ingest_logs(str(log_dir), str(events_dir), str(tmp_path / 'state.json'), workers=1, dedup_window_s=300)
+
+    assert len(load_events('2024-10-25', '2024-10-26', columns=['user_id'], events_dir=str(events_dir))) == 1
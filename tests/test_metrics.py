@@ -0,0 +1,30 @@
+"""
+Metrics of the ranking service as scraped from /metrics
+"""
+
+import os
+import sys
+
+from fastapi import FastAPI
+from fastapi.responses import PlainTextResponse
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'ranking_service'))
+from metrics import REGISTRY, cache_counter
+from result_cache import ResultCache
+
+
+def test_cache_lookups_are_exported():
+    cache = ResultCache(10)
+    cache.lookup('user', 'v1')
+    cache.store('user', 'v1', b'[]')
+    cache.lookup('user', 'v1')
+    cache_counter('test_cache_lookups_total', 'Lookups of the test cache', {'result': cache})
+    # served like GET /metrics of the app, which can not be imported without the feature store and models
+    app = FastAPI()
+    app.get('/metrics')(lambda: PlainTextResponse(REGISTRY.render()))
+    lines = TestClient(app).get('/metrics').text.splitlines()
+    assert not [line for line in lines if ' unavailable: ' in line]
+    assert 'test_cache_lookups_total{cache="result",result="hit"} 1' in lines
+    assert 'test_cache_lookups_total{cache="result",result="miss"} 1' in lines
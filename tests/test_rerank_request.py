@@ -0,0 +1,26 @@
+"""
+Validation of /rerank requests, before anything is loaded
+"""
+
+import os
+import sys
+
+import pytest
+
+pytest.importorskip('feast')
+pytest.importorskip('sentence_transformers')
+from fastapi.testclient import TestClient
+
+sys.path.append(os.path.join(os.path.dirname(__file__), '..'))
+sys.path.append(os.path.join(os.path.dirname(__file__), '..', 'ranking_service'))
+import app
+
+
+def test_titles_must_match_result_ids():
+    # without the lifespan, nothing is loaded and valid requests would get a 503
+    client = TestClient(app.app)
+    response = client.post('/rerank', json={'result_ids': ['a', 'b'], 'titles': ['A'], 'query': 'q'})
+    assert response.status_code == 422
+    assert 'one title per id' in response.text
+    response = client.post('/rerank', json={'result_ids': ['a', 'b'], 'titles': ['A', 'B'], 'query': 'q'})
+    assert response.status_code == 503
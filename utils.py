@@ -1,8 +1,11 @@
 import yaml
 import os
+import hashlib
 from sentence_transformers import SentenceTransformer
 import datetime
 
+from scoring_model.embedding_backend import model_name, optimize
+
 
 def date_to_str(date: datetime.date) -> str:
     return date.strftime('%Y-%m-%d')
@@ -25,6 +28,15 @@ def base_folder() -> str:
     return current_dir
 
 
+def file_version(*paths: str) -> str:
+    """
+    Short fingerprint of the modification times and sizes of files, which changes whenever one of them is rewritten
+    """
+    stats = [(path, os.path.getmtime(path), os.path.getsize(path)) if os.path.exists(path) else (path,)
+             for path in paths]
+    return hashlib.sha1(repr(stats).encode()).hexdigest()[:12]
+
+
 def load_config() -> dict:
     current_dir = os.path.dirname(__file__)
     with open(os.path.join(current_dir, "config.yaml"), "r") as f:
@@ -32,10 +44,21 @@ def load_config() -> dict:
     return config
 
 
+def embedding_model_name(config: dict, model=None, name: str = None) -> str:
+    """
+    Name of the embedding model (the configured one by default) under which its embeddings are stored and cached.
+    With quantization configured, it depends on the loaded model, which is only quantized if it passed the parity check.
+    """
+    return model_name(name or config['hf_model_name'], config.get('embedding_backend', {}),
+                      getattr(model, 'quantized', False))
+
+
 def load_embedding_model(config: dict) -> SentenceTransformer:
     hf_model_name = config['hf_model_name']
     cache_folder = os.path.join(base_folder(), config['model_cache_folder'])
     print(f'Loading embedding model {hf_model_name}')
     model = SentenceTransformer(hf_model_name, cache_folder=cache_folder)
+    if 'embedding_backend' in config:
+        model = optimize(model, config['embedding_backend'])
     print(f'...done')
     return model
\ No newline at end of file